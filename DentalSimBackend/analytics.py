@@ -0,0 +1,116 @@
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:  # optional: the pure-Python path gives the same numbers
+    np = None
+
+# --- CLASSROOM ANALYTICS ---
+# Cohort performance per classroom: accuracy, time to diagnosis and
+# questions asked, per disease and per category, plus a confusion matrix of
+# true disease vs. the disease the submitted diagnosis matched.
+#
+# The app keeps running totals (rollups) updated on every completed case,
+# so a report is a couple of small reads. aggregate() recomputes the same
+# totals from per-session columns in one pass - vectorized when numpy is
+# installed - to rebuild or verify the rollups.
+
+UNMATCHED = 0  # matched_disease_id for answers that matched no disease
+
+
+class DiseaseTotals:
+    __slots__ = ("completed", "correct", "seconds", "questions")
+
+    def __init__(self, completed=0, correct=0, seconds=0.0, questions=0):
+        self.completed = completed
+        self.correct = correct
+        self.seconds = seconds
+        self.questions = questions
+
+    def add(self, other):
+        self.completed += other.completed
+        self.correct += other.correct
+        self.seconds += other.seconds
+        self.questions += other.questions
+
+
+def aggregate(disease_ids, correct, seconds, questions, matched_ids):
+    # Equal-length columns, one entry per completed session. Returns
+    # ({disease_id: DiseaseTotals}, {(disease_id, matched_id): count});
+    # matched_ids entries of None are left out of the confusion matrix.
+    # An answer graded wrong cannot have matched its own disease (older rows
+    # kept sub-threshold matches), so those count as UNMATCHED.
+    if np is not None and len(disease_ids):
+        return _aggregate_numpy(disease_ids, correct, seconds, questions, matched_ids)
+
+    totals = defaultdict(DiseaseTotals)
+    confusion = defaultdict(int)
+    for disease_id, is_correct, duration, asked, matched in zip(disease_ids, correct, seconds, questions, matched_ids):
+        totals[disease_id].add(DiseaseTotals(1, int(bool(is_correct)), duration or 0.0, asked or 0))
+        if matched is not None:
+            if matched == disease_id and not is_correct:
+                matched = UNMATCHED
+            confusion[(disease_id, matched)] += 1
+    return dict(totals), dict(confusion)
+
+
+def _aggregate_numpy(disease_ids, correct, seconds, questions, matched_ids):
+    diseases, index = np.unique(np.asarray(disease_ids, dtype=np.int64), return_inverse=True)
+    size = len(diseases)
+    completed = np.bincount(index, minlength=size)
+    correct_counts = np.bincount(index, weights=np.asarray(correct, dtype=bool), minlength=size)
+    second_sums = np.bincount(index, weights=np.nan_to_num(np.asarray(seconds, dtype=float)), minlength=size)
+    question_sums = np.bincount(index, weights=np.asarray([q or 0 for q in questions], dtype=float), minlength=size)
+    totals = {
+        int(diseases[i]): DiseaseTotals(int(completed[i]), int(correct_counts[i]), float(second_sums[i]), int(question_sums[i]))
+        for i in range(size)
+    }
+
+    true_ids = np.asarray(disease_ids, dtype=np.int64)
+    matched = np.asarray([-1 if m is None else m for m in matched_ids], dtype=np.int64)
+    matched[(matched == true_ids) & ~np.asarray(correct, dtype=bool)] = UNMATCHED
+    known = matched >= 0
+    if not known.any():
+        return totals, {}
+    pairs, counts = np.unique(np.stack([true_ids[known], matched[known]], axis=1),
+                              axis=0, return_counts=True)
+    confusion = {(int(true), int(guess)): int(count) for (true, guess), count in zip(pairs, counts)}
+    return totals, confusion
+
+
+def _rates(totals):
+    return {
+        "cases_completed": totals.completed,
+        "cases_correct": totals.correct,
+        "accuracy": round(totals.correct / totals.completed, 4) if totals.completed else 0.0,
+        "avg_seconds_to_diagnosis": round(totals.seconds / totals.completed, 1) if totals.completed else None,
+        "avg_questions_per_case": round(totals.questions / totals.completed, 2) if totals.completed else None
+    }
+
+
+def build_report(totals, confusion, diseases):
+    # totals/confusion as returned by aggregate(); diseases: {id: (name, category)}
+    overall = DiseaseTotals()
+    by_category = defaultdict(DiseaseTotals)
+    per_disease = []
+    for disease_id, disease_totals in sorted(totals.items()):
+        name, category = diseases.get(disease_id, (None, None))
+        overall.add(disease_totals)
+        by_category[category].add(disease_totals)
+        per_disease.append(dict(_rates(disease_totals), disease_id=disease_id, disease=name, category=category))
+
+    def label(disease_id):
+        if disease_id == UNMATCHED:
+            return None
+        return diseases.get(disease_id, (None, None))[0]
+
+    return {
+        "overall": _rates(overall),
+        "categories": [dict(_rates(t), category=c) for c, t in sorted(by_category.items(), key=lambda item: str(item[0]))],
+        "diseases": per_disease,
+        "confusion": [
+            {"disease_id": true, "disease": label(true), "matched_disease_id": guess or None,
+             "matched": label(guess), "count": count}
+            for (true, guess), count in sorted(confusion.items())
+        ]
+    }
@@ -1,28 +1,283 @@
+import io
 import os
+import csv
+import hmac
+import json
+import base64
+import time
+import sqlite3
+import threading
+import hashlib
+import functools
 import datetime
-import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.sql.expression import func
+from dotenv import load_dotenv
+from sqlalchemy import event, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import func, case
+from llm_gateway import LLMGateway, GatewayBusy, GatewayTimeout, GatewayUnavailable, LLMError
+from model_router import ModelRouter
+from response_cache import ResponseCache
+from context_store import InMemoryContextStore, SessionContext
+from context_builder import ContextBuilder, load_estimator
+from badges import BadgeContext, evaluate_badges
+from leaderboard import Leaderboard
+from migrations import run_migrations
+from case_scheduler import CaseScheduler
+from disease_registry import DiseaseRegistry, load_catalog_file
+from diagnosis_matcher import DiagnosisMatcher
+from metrics import MetricsRegistry, COUNT_BUCKETS, TOKEN_BUCKETS
+from write_behind import WriteBehindQueue
+from process_lock import startup_lock
+from credentials import PasswordHasher, CredentialsBusy, RateLimiter
+from analytics import DiseaseTotals, aggregate, build_report, UNMATCHED
 
 # --- APP CONFIGURATION ---
+load_dotenv()
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///dentalsim.db'
+# --- DATABASE CONFIGURATION ---
+# DATABASE_URL selects the database (SQLite by default). Postgres needs the
+# psycopg2 driver installed; SQLite is tuned for many concurrent readers.
+database_url = os.environ.get("DATABASE_URL", "sqlite:///dentalsim.db")
+if database_url.startswith("postgres://"):
+    database_url = "postgresql://" + database_url[len("postgres://"):]
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'super-secret-dental-key-change-me'
 
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+
+if database_url.startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "connect_args": {"timeout": app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000.0, "check_same_thread": False}
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True
+    }
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a write is in progress; the busy timeout
+    # makes writers wait for the lock instead of failing with "database is locked".
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.close()
+
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 
-COLAB_URL = "https://adrenergic-maisie-unenlightened.ngrok-free.dev"
-HF_URL = f"{COLAB_URL}/generate"
+# --- METRICS ---
+# Prometheus text format on /metrics (METRICS_ENABLED=0 hides the endpoint).
+# SLOW_REQUEST_MS > 0 logs every request slower than that, with its DB time.
+app.config['METRICS_ENABLED'] = os.environ.get("METRICS_ENABLED", "1") == "1"
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get("SLOW_REQUEST_MS", 0))
+
+metrics = MetricsRegistry(prefix="dentalsim_")
+request_duration = metrics.histogram("http_request_duration_seconds", "Time to produce the response (headers, for streams)", ["method", "route", "status"])
+request_db_queries = metrics.histogram("http_request_db_queries", "DB queries issued per request", ["route"], buckets=COUNT_BUCKETS)
+request_db_seconds = metrics.histogram("http_request_db_seconds", "DB time per request", ["route"])
+db_query_duration = metrics.histogram("db_query_duration_seconds", "Duration of single DB statements")
+llm_timings = metrics.histogram("llm_seconds", "LLM gateway timings: queue_wait, first_token, generation", ["phase"])
+llm_tokens_out = metrics.histogram("llm_tokens_out", "Estimated tokens per patient reply", buckets=TOKEN_BUCKETS)
+llm_errors = metrics.counter("llm_errors_total", "Patient replies that failed, by kind", ["kind"])
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    db_query_duration.observe(elapsed)
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+@event.listens_for(Engine, "handle_error")
+def drop_query_timer(context):
+    # Failed statements never reach after_cursor_execute; without this their
+    # start times pile up on the pooled connection.
+    if context.connection is None or context.execution_context is None:
+        return
+    started = context.connection.info.get("query_started")
+    if started:
+        started.pop()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_started" not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    # The rule, not the path, so /admin/diseases/<id> stays one series.
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_duration.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    request_db_queries.observe(g.db_queries, route=route)
+    request_db_seconds.observe(g.db_seconds, route=route)
+
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        app.logger.warning("Slow request: %s %s -> %s in %.0f ms (%d queries, %.0f ms DB)",
+                           request.method, request.path, response.status_code,
+                           elapsed * 1000, g.db_queries, g.db_seconds * 1000)
+    return response
+
+COLAB_URL = os.environ.get("COLAB_URL", "https://adrenergic-maisie-unenlightened.ngrok-free.dev")
 HF_HEADERS = {"Content-Type": "application/json"}
 
+# Patient model replicas: comma-separated base URLs, each serving /generate
+# (and ideally /health). Defaults to the single COLAB_URL generator.
+app.config['LLM_ENDPOINTS'] = [url.strip() for url in os.environ.get("LLM_ENDPOINTS", COLAB_URL).split(",") if url.strip()]
+# Replicas tried per reply, hedge delay (0 ms = no hedging), failures in a
+# row that take a replica out of rotation and for how long, and how often
+# replicas are health-checked (0 s = never). See model_router.py.
+app.config['LLM_MAX_ATTEMPTS'] = int(os.environ.get("LLM_MAX_ATTEMPTS", 2))
+app.config['LLM_HEDGE_MS'] = float(os.environ.get("LLM_HEDGE_MS", 0))
+app.config['LLM_BREAKER_FAILURES'] = int(os.environ.get("LLM_BREAKER_FAILURES", 3))
+app.config['LLM_BREAKER_OPEN_SECONDS'] = float(os.environ.get("LLM_BREAKER_OPEN_SECONDS", 30))
+app.config['LLM_HEALTH_INTERVAL'] = float(os.environ.get("LLM_HEALTH_INTERVAL", 10))
+
+# LLM gateway limits: generations running at once, requests allowed to wait
+# for a slot, and the deadline (seconds) for a single patient reply.
+app.config['LLM_MAX_IN_FLIGHT'] = int(os.environ.get("LLM_MAX_IN_FLIGHT", 8))
+app.config['LLM_MAX_QUEUE'] = int(os.environ.get("LLM_MAX_QUEUE", 32))
+app.config['LLM_TIMEOUT'] = float(os.environ.get("LLM_TIMEOUT", 120))
+app.config['LLM_RETRY_AFTER'] = int(os.environ.get("LLM_RETRY_AFTER", 5))
+
+# Requests waiting for or holding a gateway slot each occupy a server
+# thread, so under serve.py (which exports WEB_THREADS) the limits are cut
+# to leave LLM_RESERVED_THREADS threads (default a quarter, at least 2) for
+# login, profile and leaderboard calls; beyond that students get a 429.
+app.config['WEB_THREADS'] = int(os.environ.get("WEB_THREADS", 0))  # 0 = not known (dev server)
+app.config['LLM_RESERVED_THREADS'] = int(os.environ.get("LLM_RESERVED_THREADS", max(2, app.config['WEB_THREADS'] // 4)))
+if app.config['WEB_THREADS']:
+    llm_thread_budget = max(1, app.config['WEB_THREADS'] - app.config['LLM_RESERVED_THREADS'])
+    if app.config['LLM_MAX_IN_FLIGHT'] + app.config['LLM_MAX_QUEUE'] > llm_thread_budget:
+        app.config['LLM_MAX_IN_FLIGHT'] = min(app.config['LLM_MAX_IN_FLIGHT'], llm_thread_budget)
+        app.config['LLM_MAX_QUEUE'] = llm_thread_budget - app.config['LLM_MAX_IN_FLIGHT']
+        print(f"LLM gateway limited to {app.config['LLM_MAX_IN_FLIGHT']} in flight + {app.config['LLM_MAX_QUEUE']} queued "
+              f"to fit {app.config['WEB_THREADS']} server threads")
+
+# Optional micro-batching of /chat generations (0 ms window = off). The
+# generator must expose the batched endpoint, see LLMGateway._send_batch.
+# Batches all go to LLM_BATCH_URL, not through the replica routing.
+app.config['LLM_BATCH_URL'] = os.environ.get("LLM_BATCH_URL", f"{COLAB_URL}/generate_batch")
+app.config['LLM_BATCH_WINDOW_MS'] = float(os.environ.get("LLM_BATCH_WINDOW_MS", 0))
+app.config['LLM_BATCH_MAX_SIZE'] = int(os.environ.get("LLM_BATCH_MAX_SIZE", 8))
+
+model_router = ModelRouter(
+    app.config['LLM_ENDPOINTS'],
+    headers=HF_HEADERS,
+    pool_maxsize=app.config['LLM_MAX_IN_FLIGHT'],
+    max_attempts=app.config['LLM_MAX_ATTEMPTS'],
+    hedge_after_ms=app.config['LLM_HEDGE_MS'],
+    failure_threshold=app.config['LLM_BREAKER_FAILURES'],
+    open_seconds=app.config['LLM_BREAKER_OPEN_SECONDS'],
+    health_interval=app.config['LLM_HEALTH_INTERVAL']
+)
+llm_gateway = LLMGateway(
+    model_router,
+    max_in_flight=app.config['LLM_MAX_IN_FLIGHT'],
+    max_queue=app.config['LLM_MAX_QUEUE'],
+    timeout=app.config['LLM_TIMEOUT'],
+    retry_after=app.config['LLM_RETRY_AFTER'],
+    batch_url=app.config['LLM_BATCH_URL'],
+    batch_window_ms=app.config['LLM_BATCH_WINDOW_MS'],
+    batch_max_size=app.config['LLM_BATCH_MAX_SIZE'],
+    on_timing=lambda phase, seconds: llm_timings.observe(seconds, phase=phase)
+)
+metrics.callback("llm_requests", "Patient replies waiting for / holding a gateway slot", "gauge",
+                 lambda: {("waiting",): llm_gateway.waiting, ("running",): llm_gateway.running}, ["state"])
+metrics.callback("llm_endpoint_up", "1 while the replica's circuit is closed", "gauge",
+                 lambda: {(b["url"],): int(b["state"] == "closed") for b in model_router.snapshot()}, ["endpoint"])
+metrics.callback("llm_endpoint_in_flight", "Calls in progress per replica", "gauge",
+                 lambda: {(b["url"],): b["in_flight"] for b in model_router.snapshot()}, ["endpoint"])
+metrics.callback("llm_endpoint_failures_total", "Failed calls per replica", "counter",
+                 lambda: {(b["url"],): b["failures"] for b in model_router.snapshot()}, ["endpoint"])
+metrics.callback("llm_retries_total", "Calls retried on another replica", "counter", lambda: model_router.retries)
+metrics.callback("llm_hedges_total", "Hedged calls sent to a second replica", "counter", lambda: model_router.hedges)
+
+# Patient reply cache (0 entries = off). RESPONSE_CACHE_CONTEXT is how many
+# messages before the question must match for a cached reply to be reused.
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 2048))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+app.config['RESPONSE_CACHE_CONTEXT'] = int(os.environ.get("RESPONSE_CACHE_CONTEXT", 2))
+
+response_cache = ResponseCache(
+    max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+    ttl=app.config['RESPONSE_CACHE_TTL'],
+    context_messages=app.config['RESPONSE_CACHE_CONTEXT']
+)
+
+# Rolling per-session context: messages kept before the new question, and
+# how many sessions one process keeps in memory. How much of the window is
+# actually sent is decided by the token budget below.
+app.config['CONTEXT_WINDOW_MESSAGES'] = int(os.environ.get("CONTEXT_WINDOW_MESSAGES", 30))
+app.config['CONTEXT_STORE_MAX_SESSIONS'] = int(os.environ.get("CONTEXT_STORE_MAX_SESSIONS", 5000))
+app.config['CONTEXT_STORE_IDLE_TTL'] = int(os.environ.get("CONTEXT_STORE_IDLE_TTL", 3600))
+# Each process keeps its own store, so with several worker processes a
+# cached context is checked against the session's message count before use
+# (one indexed COUNT per turn) and rebuilt if another worker saved a turn
+# meanwhile. On by default when WEB_CONCURRENCY > 1 (serve.py exports it);
+# set CONTEXT_STORE_VERIFY=1 when starting several processes another way.
+app.config['CONTEXT_STORE_VERIFY'] = os.environ.get(
+    "CONTEXT_STORE_VERIFY", "1" if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1 else "0") == "1"
+
+context_store = InMemoryContextStore(
+    max_sessions=app.config['CONTEXT_STORE_MAX_SESSIONS'],
+    idle_ttl=app.config['CONTEXT_STORE_IDLE_TTL']
+)
+
+# Prompt budget for the patient model. CONTEXT_TOKENIZER="hf:<model>" counts
+# tokens with the model's own tokenizer instead of the ~4 chars/token estimate.
+app.config['CONTEXT_MAX_PROMPT_TOKENS'] = int(os.environ.get("CONTEXT_MAX_PROMPT_TOKENS", 1536))
+app.config['CONTEXT_SUMMARIZE'] = os.environ.get("CONTEXT_SUMMARIZE", "0") == "1"
+app.config['CONTEXT_TOKENIZER'] = os.environ.get("CONTEXT_TOKENIZER", "")
+app.config['LLM_MAX_NEW_TOKENS'] = int(os.environ.get("LLM_MAX_NEW_TOKENS", 150))
+app.config['LLM_TEMPERATURE'] = float(os.environ.get("LLM_TEMPERATURE", 0.2))
+
+context_builder = ContextBuilder(
+    max_prompt_tokens=app.config['CONTEXT_MAX_PROMPT_TOKENS'],
+    max_new_tokens=app.config['LLM_MAX_NEW_TOKENS'],
+    temperature=app.config['LLM_TEMPERATURE'],
+    estimator=load_estimator(app.config['CONTEXT_TOKENIZER']),
+    summarize=app.config['CONTEXT_SUMMARIZE']
+)
+
+metrics.callback("cache_hits_total", "Cache lookups answered from memory", "counter",
+                 lambda: {("response",): response_cache.hits, ("context",): context_store.hits}, ["cache"])
+metrics.callback("cache_misses_total", "Cache lookups that fell through", "counter",
+                 lambda: {("response",): response_cache.misses, ("context",): context_store.misses}, ["cache"])
+metrics.callback("response_cache_evictions_total", "Cached patient replies dropped by TTL or size limit", "counter",
+                 lambda: response_cache.evictions)
+metrics.callback("response_cache_entries", "Patient replies currently cached", "gauge", lambda: len(response_cache))
+if llm_gateway.batcher:
+    metrics.callback("llm_batch_items_total", "Generations sent in batches", "counter", lambda: llm_gateway.batcher.items_sent)
+    metrics.callback("llm_batches_total", "Batches sent to the generator", "counter", lambda: llm_gateway.batcher.batches_sent)
+
 # --- DATABASE MODELS ---
 
 class Classroom(db.Model):
@@ -36,8 +291,8 @@ class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
-    xp = db.Column(db.Integer, default=0)
+    password_hash = db.Column(db.String(255), nullable=False)
+    xp = db.Column(db.Integer, default=0, index=True)
     classroom_id = db.Column(db.Integer, db.ForeignKey('classroom.id'), nullable=True)
 
     # Gamification Stats
@@ -55,9 +310,36 @@ class Disease(db.Model):
     name = db.Column(db.String(100), unique=True, nullable=False)
     category = db.Column(db.String(50), default='General') # <--- New for specialist badges
     system_prompt = db.Column(db.Text, nullable=False)
+    prompt_version = db.Column(db.Integer, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    synonyms = db.Column(db.Text, nullable=True) # JSON list of synonyms and abbreviations
+
+# Every prompt a disease has had, so sessions and replays can be traced back
+# to the exact prompt that was live.
+class DiseaseCatalogSync(db.Model):
+    __tablename__ = 'disease_catalog_sync'
+    id = db.Column(db.Integer, primary_key=True)  # a single row, id 1
+    digest = db.Column(db.String(64), nullable=False)  # sha256 of the file
+    version = db.Column(db.Integer, nullable=True)
+    synced_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class DiseasePromptVersion(db.Model):
+    __tablename__ = 'disease_prompt_version'
+    __table_args__ = (
+        db.Index('uq_disease_prompt_version', 'disease_id', 'version', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('disease.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    system_prompt = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
 class ChatSession(db.Model):
     __tablename__ = 'chat_session'
+    __table_args__ = (
+        db.Index('ix_chat_session_user_completed', 'user_id', 'is_completed', 'was_correct'),
+        db.Index('ix_chat_session_user_start', 'user_id', 'start_time', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     disease_id = db.Column(db.Integer, db.ForeignKey('disease.id'), nullable=False)
@@ -65,12 +347,19 @@ class ChatSession(db.Model):
     end_time = db.Column(db.DateTime, nullable=True)
     is_completed = db.Column(db.Boolean, default=False)
     was_correct = db.Column(db.Boolean, default=False)
+    # Recorded when the case is first diagnosed, for classroom analytics.
+    submitted_diagnosis = db.Column(db.Text, nullable=True)
+    matched_disease_id = db.Column(db.Integer, nullable=True)  # 0 = matched nothing
+    question_count = db.Column(db.Integer, nullable=True)
 
     messages = db.relationship('ChatMessage', backref='session', lazy=True, order_by="ChatMessage.timestamp")
     disease = db.relationship('Disease')
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        db.Index('ix_chat_message_session_timestamp', 'session_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
     sender = db.Column(db.String(20), nullable=False)
@@ -79,183 +368,312 @@ class ChatMessage(db.Model):
 
 class UserBadge(db.Model):
     __tablename__ = 'user_badge'
+    __table_args__ = (
+        db.Index('uq_user_badge_user_badge', 'user_id', 'badge_name', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     badge_name = db.Column(db.String(50), nullable=False)
     awarded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
-# --- SEED DATA ---
-DISEASE_DATA = [
-    {
-        "name": "Simple Caries",
-        "prompt": """### ROLE
-You are a simulated dental patient. You are talking to a dental student.
-Your diagnosis is **Simple Caries** (HIDDEN). Do not reveal the diagnosis name directly.
-
-### SYMPTOMS YOU HAVE (TRUE - CONFIRM THESE)
-* **Provoked Pain:** You feel a sharp, quick "zing" specifically to **cold** and **sweets**.
-* **Short Duration:** The pain disappears **immediately** (1-2 seconds) after the stimulus is gone.
-* **Food Impaction:** Food sometimes gets stuck between teeth.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE - DENY THESE)
-* **NO Spontaneous Pain:** The tooth NEVER hurts on its own.
-* **NO Night Pain:** You sleep perfectly fine.
-* **NO Percussion Pain:** Tapping on the tooth does NOT hurt.
-* **NO Heat Sensitivity:** Hot coffee does not bother you.
-
-### BEHAVIOR GUIDELINES
-1. **Be Layman:** Use words like "cavity" or "sting".
-2. **Be Calm:** You are annoyed by the sweet sensitivity, but not in agony.
-3. **Refuse Irrelevance:** If asked about hobbies/dinner, refuse politely."""
-    },
-    {
-        "name": "Reversible Pulpitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Reversible Pulpitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Provoked Pain:** Sharp pain to **cold** and **air**.
-* **Short Duration:** Pain stops quickly (under 30 seconds) after stimulus removal.
-* **Biting Pain:** You feel pain when chewing directly on that tooth (due to a cavity).
-* **History:** You have a deep cavity or old filling.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Spontaneous Pain:** Never hurts without a trigger.
-* **NO Night Pain:** Does not wake you up.
-* **NO Heat Sensitivity:** Heat does not trigger it.
-* **NO Pulsating:** It is not a heartbeat pain.
-
-### BEHAVIOR GUIDELINES
-1. **Be Layman:** Describe symptoms simply.
-2. **Be Concise:** Short answers."""
-    },
-    {
-        "name": "Irreversible Pulpitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Irreversible Pulpitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Spontaneous Pain:** Starts hurting suddenly without reason.
-* **Night Pain:** Severe pain wakes you up at night.
-* **Lingering Cold Pain:** Pain to cold lasts for minutes (lingers > 60s).
-* **Radiating:** Pain shoots to the ear/temple.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Swelling:** Face is not swollen.
-* **NO Bad Taste:** No pus discharge.
-* **NO Heat Relief:** Cold does not make it better (actually makes it worse).
-
-### BEHAVIOR GUIDELINES
-1. **Be Distressed:** You are tired and in pain.
-2. **Refuse Irrelevance:** Do not answer personal questions."""
-    },
-    {
-        "name": "Acute Total Pulpitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Acute Total Pulpitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Violent Pain:** Unbearable throbbing pain (9/10).
-* **Thermal Sensitivity:** BOTH Cold and Heat cause extreme, lingering pain.
-* **Night Pain:** Keeps you awake all night.
-* **Spontaneous:** Hurts constantly.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Swelling:** No visible swelling yet.
-* **NO Fistula:** No bump on the gum.
-
-### BEHAVIOR GUIDELINES
-1. **Be Agitated:** You are in agony. Demand help.
-2. **Short Temper:** Get angry if the doctor asks stupid questions."""
-    },
-    {
-        "name": "Pulp Necrosis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Pulp Necrosis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Dead Tooth:** You feel NOTHING to cold or heat (Negative Vitality Test).
-* **History:** You had severe pain days ago, but it suddenly stopped.
-* **Mild Tenderness:** Tapping the tooth feels slightly "different".
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Severe Pain:** Currently, nothing hurts badly.
-* **NO Response to Cold:** Explicitly say "I don't feel anything".
-
-### BEHAVIOR GUIDELINES
-1. **Be Confused:** Wonder why the pain stopped but the tooth feels "numb"."""
-    },
-    {
-        "name": "Acute Apical Periodontitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Acute Apical Periodontitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **High Tooth:** Sensation that the tooth is "longer" or "taller".
-* **Biting Pain:** Severe pain when chewing/touching the tooth.
-* **Percussion:** Extreme pain on vertical tapping.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Cold Sensation:** The nerve is likely dead (or dying).
-* **NO Swelling:** Face is not swollen (distinguishes from abscess).
-
-### BEHAVIOR GUIDELINES
-1. **Be Protective:** You are afraid to close your mouth fully."""
-    },
-    {
-        "name": "Chronic Apical Periodontitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Chronic Apical Periodontitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Fistula:** A small "pimple" on the gum that comes and goes.
-* **Bad Taste:** Salty/metallic taste (pus draining).
-* **Dead Tooth:** No feeling to cold/heat.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Severe Pain:** It is just a dull annoyance/pressure.
-* **NO Night Pain:** You sleep fine.
-
-### BEHAVIOR GUIDELINES
-1. **Be Calm:** Describe the recurring bump on the gum."""
-    },
-    {
-        "name": "Periodontal Abscess",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Periodontal Abscess** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Vital Tooth:** You FEEL cold normally (nerve is alive).
-* **Gum Pain:** Pain is "in the gum", not deep in the tooth.
-* **Swelling:** Localized gum swelling/pus.
-* **Lateral Pain:** Hurts if pushed from the side.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Vertical Pain:** Tapping top of tooth is usually fine.
-* **NO Dead Nerve:** Confirm you feel temperature.
-
-### BEHAVIOR GUIDELINES
-1. **Complain:** Mention food getting stuck between teeth."""
-    },
-    {
-        "name": "Pericoronitis",
-        "prompt": """### ROLE
-You are a simulated dental patient. Diagnosis: **Pericoronitis** (HIDDEN).
-
-### SYMPTOMS YOU HAVE (TRUE)
-* **Trismus:** Cannot open mouth fully (jaw locks).
-* **Swallowing Pain:** Pain radiates to ear/throat.
-* **Location:** Wisdom tooth (very back).
-* **Bad Taste:** Salty discharge.
-
-### SYMPTOMS YOU DO NOT HAVE (FALSE)
-* **NO Cold Sensitivity:** Tooth is fine, gum is the problem.
-* **NO Night Pain:** It's constant dull ache.
-
-### BEHAVIOR GUIDELINES
-1. **Be Muffled:** Indicate it's hard to speak/open mouth."""
-    }
-]
+# Running counters maintained by check_diagnosis, so badges and stats never
+# have to count a student's whole case history.
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    cases_completed = db.Column(db.Integer, default=0, nullable=False)
+    cases_correct = db.Column(db.Integer, default=0, nullable=False)
+
+class UserCategoryStats(db.Model):
+    __tablename__ = 'user_category_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+    cases_completed = db.Column(db.Integer, default=0, nullable=False)
+    cases_correct = db.Column(db.Integer, default=0, nullable=False)
+
+# Per-disease counters behind adaptive case selection (case_scheduler.py).
+class UserDiseaseStats(db.Model):
+    __tablename__ = 'user_disease_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('disease.id'), primary_key=True)
+    cases_completed = db.Column(db.Integer, default=0, nullable=False)
+    cases_correct = db.Column(db.Integer, default=0, nullable=False)
+
+# Running per-classroom totals behind the instructor analytics (analytics.py).
+class ClassroomDiseaseStats(db.Model):
+    __tablename__ = 'classroom_disease_stats'
+    classroom_id = db.Column(db.Integer, db.ForeignKey('classroom.id'), primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('disease.id'), primary_key=True)
+    cases_completed = db.Column(db.Integer, default=0, nullable=False)
+    cases_correct = db.Column(db.Integer, default=0, nullable=False)
+    total_seconds = db.Column(db.Float, default=0, nullable=False)
+    total_questions = db.Column(db.Integer, default=0, nullable=False)
+
+class ClassroomConfusion(db.Model):
+    __tablename__ = 'classroom_confusion'
+    classroom_id = db.Column(db.Integer, db.ForeignKey('classroom.id'), primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('disease.id'), primary_key=True)
+    matched_disease_id = db.Column(db.Integer, primary_key=True)  # 0 = matched nothing
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+# One row per XP award, used for time-windowed (weekly) leaderboards.
+class XpEvent(db.Model):
+    __tablename__ = 'xp_event'
+    __table_args__ = (
+        db.Index('ix_xp_event_created_user', 'created_at', 'user_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+# --- LEADERBOARD ---
+def load_leaderboard_users():
+    return db.session.query(User.id, User.classroom_id, User.xp).all()
+
+def load_leaderboard_weekly(since):
+    return db.session.query(User.id, User.classroom_id, func.sum(XpEvent.amount)).join(
+        XpEvent, XpEvent.user_id == User.id
+    ).filter(XpEvent.created_at >= since).group_by(User.id, User.classroom_id).all()
+
+app.config['LEADERBOARD_REFRESH_SECONDS'] = int(os.environ.get("LEADERBOARD_REFRESH_SECONDS", 60))
+
+leaderboard = Leaderboard(
+    load_leaderboard_users,
+    load_leaderboard_weekly,
+    refresh_seconds=app.config['LEADERBOARD_REFRESH_SECONDS']
+)
+
+# --- DISEASE CATALOG ---
+# diseases.json is the versioned source of the catalog. It is written into
+# the DB at startup and, while DISEASE_CATALOG_WATCH is on, whenever the file
+# changes; requests read the catalog from the in-memory registry. The digest
+# of the last file synced is kept in the DB, so restarts and new workers do
+# not reapply an unchanged file over prompts edited through the admin API
+# (POST /admin/diseases/reload reapplies it on purpose).
+app.config['DISEASE_CATALOG_PATH'] = os.environ.get("DISEASE_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "diseases.json"))
+app.config['DISEASE_CATALOG_WATCH'] = os.environ.get("DISEASE_CATALOG_WATCH", "1") == "1"
+app.config['DISEASE_REGISTRY_CHECK_SECONDS'] = int(os.environ.get("DISEASE_REGISTRY_CHECK_SECONDS", 30))
+app.config['ADMIN_TOKEN'] = os.environ.get("ADMIN_TOKEN", "")
+
+def record_prompt_version(disease):
+    db.session.add(DiseasePromptVersion(
+        disease_id=disease.id, version=disease.prompt_version, system_prompt=disease.system_prompt
+    ))
+
+def update_disease(disease, name=None, category=None, system_prompt=None, synonyms=None):
+    if name:
+        disease.name = name
+    if category:
+        disease.category = category
+    if synonyms is not None:
+        disease.synonyms = json.dumps(synonyms)
+    if system_prompt and system_prompt != disease.system_prompt:
+        disease.system_prompt = system_prompt
+        disease.prompt_version = (disease.prompt_version or 1) + 1
+        record_prompt_version(disease)
+    disease.updated_at = datetime.datetime.utcnow()
+
+def sync_disease_catalog(path, force=False):
+    # Adds new diseases and updates changed ones; diseases missing from the
+    # file are kept, since past sessions still reference them. Skipped when
+    # this exact file was synced before, unless forced.
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    last_sync = db.session.get(DiseaseCatalogSync, 1)
+    if last_sync is not None and last_sync.digest == digest and not force:
+        return 0
+
+    version, entries = load_catalog_file(path)
+    existing = {d.name: d for d in Disease.query.all()}
+    changed = 0
+    for entry in entries:
+        disease = existing.get(entry["name"])
+        synonyms = json.dumps(entry["synonyms"])
+        if disease is None:
+            disease = Disease(name=entry["name"], category=entry["category"], system_prompt=entry["prompt"], prompt_version=1, synonyms=synonyms)
+            db.session.add(disease)
+            db.session.flush()
+            record_prompt_version(disease)
+            changed += 1
+        elif disease.system_prompt != entry["prompt"] or disease.category != entry["category"] or disease.synonyms != synonyms:
+            update_disease(disease, category=entry["category"], system_prompt=entry["prompt"], synonyms=entry["synonyms"])
+            changed += 1
+    if last_sync is None:
+        db.session.add(DiseaseCatalogSync(id=1, digest=digest, version=version))
+    else:
+        last_sync.digest, last_sync.version, last_sync.synced_at = digest, version, datetime.datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker synced the same file first.
+        db.session.rollback()
+        return 0
+    if changed:
+        print(f"Disease catalog v{version}: {changed} disease(s) added or updated.")
+    return changed
+
+def load_disease_entries():
+    return db.session.query(Disease.id, Disease.name, Disease.category, Disease.system_prompt, Disease.prompt_version, Disease.synonyms).all()
+
+def load_disease_stamp():
+    return tuple(db.session.query(func.count(Disease.id), func.max(Disease.updated_at), func.sum(Disease.prompt_version)).one())
+
+def sync_disease_catalog_in_background(path):
+    # The registry notices a changed file from inside whatever request reads
+    # the catalog next. The sync runs on its own thread and app context (so
+    # its own DB session) and leaves that request's transaction alone; the
+    # registry reloads once it has committed.
+    def run():
+        with app.app_context():
+            try:
+                sync_disease_catalog(path)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Disease catalog sync failed: {e}")
+                return
+        disease_registry.invalidate()
+    threading.Thread(target=run, name="disease-catalog-sync", daemon=True).start()
+
+disease_registry = DiseaseRegistry(
+    load_disease_entries,
+    load_disease_stamp,
+    check_seconds=app.config['DISEASE_REGISTRY_CHECK_SECONDS'],
+    catalog_path=app.config['DISEASE_CATALOG_PATH'] if app.config['DISEASE_CATALOG_WATCH'] else None,
+    sync_catalog=sync_disease_catalog_in_background
+)
+
+# Anything derived from a disease prompt is dropped when the prompt changes.
+disease_registry.on_change(context_store.evict_disease)
+disease_registry.on_change(response_cache.invalidate_disease)
+
+# --- DIAGNOSIS MATCHING ---
+# Minimum confidence for a free-text diagnosis to count as a match.
+app.config['DIAGNOSIS_MATCH_THRESHOLD'] = float(os.environ.get("DIAGNOSIS_MATCH_THRESHOLD", 0.85))
+
+_diagnosis_matcher = {"generation": None, "matcher": None}
+
+def get_diagnosis_matcher():
+    # Rebuilt whenever the registry reloads the catalog.
+    entries = disease_registry.all()
+    if _diagnosis_matcher["generation"] != disease_registry.generation:
+        _diagnosis_matcher["matcher"] = DiagnosisMatcher([(d.id, d.name, d.synonyms) for d in entries])
+        _diagnosis_matcher["generation"] = disease_registry.generation
+    return _diagnosis_matcher["matcher"]
+
+# --- CASE SELECTION ---
+def load_case_catalog():
+    return [(d.id, d.name, d.category) for d in disease_registry.all()]
+
+# CASE_SELECTION: "adaptive" (weighted towards weak categories) or "uniform".
+app.config['CASE_SELECTION'] = os.environ.get("CASE_SELECTION", "adaptive")
+app.config['CASE_RECENT_WINDOW'] = int(os.environ.get("CASE_RECENT_WINDOW", 3))
+
+case_scheduler = CaseScheduler(load_case_catalog, mode=app.config['CASE_SELECTION'])
+disease_registry.on_change(lambda disease_id: case_scheduler.invalidate())
+
+# --- CHAT PERSISTENCE ---
+# CHAT_WRITE_BEHIND=1 takes chat message commits off the request path: rows
+# are buffered and written in batches of up to CHAT_WRITE_BEHIND_BATCH, at
+# most CHAT_WRITE_BEHIND_INTERVAL_MS after they were sent.
+app.config['CHAT_WRITE_BEHIND'] = os.environ.get("CHAT_WRITE_BEHIND", "0") == "1"
+app.config['CHAT_WRITE_BEHIND_BATCH'] = int(os.environ.get("CHAT_WRITE_BEHIND_BATCH", 200))
+app.config['CHAT_WRITE_BEHIND_INTERVAL_MS'] = float(os.environ.get("CHAT_WRITE_BEHIND_INTERVAL_MS", 50))
+
+def write_chat_messages(rows):
+    with app.app_context():
+        db.session.bulk_insert_mappings(ChatMessage, rows)
+        db.session.commit()
+
+chat_writer = None
+if app.config['CHAT_WRITE_BEHIND']:
+    chat_writer = WriteBehindQueue(
+        write_chat_messages,
+        max_batch=app.config['CHAT_WRITE_BEHIND_BATCH'],
+        interval_ms=app.config['CHAT_WRITE_BEHIND_INTERVAL_MS']
+    )
+    metrics.callback("chat_write_behind_pending", "Chat messages waiting to be written", "gauge", chat_writer.pending_count)
+    metrics.callback("chat_write_behind_rows_total", "Chat messages written by the write-behind queue", "counter", lambda: chat_writer.rows_written)
+    metrics.callback("chat_write_behind_failures_total", "Failed write-behind batches (retried)", "counter", lambda: chat_writer.failures)
+    metrics.callback("chat_write_behind_rejected_total", "Chat messages set aside after failing repeatedly", "counter", lambda: chat_writer.rows_rejected)
+
+# --- CREDENTIALS ---
+# Password hashing runs on PASSWORD_HASH_WORKERS processes (0 = on the
+# request thread), with at most PASSWORD_HASH_MAX_PENDING hashes waiting.
+# Changing PASSWORD_HASH_METHOD rehashes each password on its next login.
+# Attempts are limited per client address (login and register) and failed
+# logins per username; classes often share one address, so the address
+# limit is generous.
+#
+# The pool is only used when the app is imported (serve.py, gunicorn): its
+# processes are spawned and import the launching script, so under
+# `python app.py` each of them would re-run this whole module. The
+# development server hashes on the request thread.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2)) if __name__ != "__main__" else 0
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+app.config['AUTH_IP_MAX_ATTEMPTS'] = int(os.environ.get("AUTH_IP_MAX_ATTEMPTS", 120))
+app.config['AUTH_IP_WINDOW'] = int(os.environ.get("AUTH_IP_WINDOW", 60))
+app.config['AUTH_USER_MAX_FAILURES'] = int(os.environ.get("AUTH_USER_MAX_FAILURES", 10))
+app.config['AUTH_USER_WINDOW'] = int(os.environ.get("AUTH_USER_WINDOW", 300))
+
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING']
+)
+auth_ip_limiter = RateLimiter(app.config['AUTH_IP_MAX_ATTEMPTS'], app.config['AUTH_IP_WINDOW'])
+login_failure_limiter = RateLimiter(app.config['AUTH_USER_MAX_FAILURES'], app.config['AUTH_USER_WINDOW'])
+auth_throttled = metrics.counter("auth_throttled_total", "Login/register attempts refused, by reason", ["reason"])
+
+def too_many_attempts(retry_after, reason):
+    auth_throttled.inc(reason=reason)
+    response = jsonify({"error": "Too many attempts, try again later"})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+def credentials_busy_response(error):
+    return too_many_attempts(error.retry_after, "busy")
+
+# --- REQUEST IDENTITY ---
+# The JWT is verified once by @jwt_required; these keep the caller's id and
+# User row for the rest of the request, and load sessions only together
+# with the ownership check.
+def current_user_id():
+    # Identities are issued as strings.
+    identity = get_jwt_identity()
+    return int(identity) if identity is not None else None
+
+def current_user():
+    # The caller's User row, loaded at most once per request.
+    if "current_user" not in g:
+        g.current_user = db.session.get(User, current_user_id())
+    return g.current_user
+
+def load_owned_session(session_id, with_user=False):
+    # The caller's ChatSession, or None. with_user=True loads the User row
+    # in the same query.
+    owned = (ChatSession.id == session_id, ChatSession.user_id == current_user_id())
+    if not with_user:
+        return ChatSession.query.filter(*owned).first()
+    row = db.session.query(ChatSession, User).join(User, User.id == ChatSession.user_id).filter(*owned).first()
+    if row is None:
+        return None
+    g.current_user = row[1]
+    return row[0]
+
+def load_owned_context(session_id):
+    # Chat turns only need the context; a cached one already records its
+    # owner, so the session row is read only when the context is rebuilt.
+    context = context_store.get(session_id)
+    if context is not None:
+        if context.user_id != current_user_id():
+            return None
+        if context.message_count is None or context.message_count == stored_message_count(session_id):
+            return context
+        context_store.evict(session_id)
+    session = load_owned_session(session_id)
+    return load_session_context(session) if session else None
 
 # --- ROUTES ---
 
@@ -266,6 +684,11 @@ def register():
     password = data.get("password", "")
     class_code = data.get("class_code", "").strip()
 
+    retry_after = auth_ip_limiter.retry_after(request.remote_addr)
+    if retry_after:
+        return too_many_attempts(retry_after, "address")
+    auth_ip_limiter.hit(request.remote_addr)
+
     # NEW: Get role from request, default to 'Dental Student' if missing
     role = data.get("role", "Dental Student").strip()
 
@@ -281,14 +704,20 @@ def register():
         if classroom:
             assigned_class_id = classroom.id
 
+    try:
+        password_hash = password_hasher.hash(password)
+    except CredentialsBusy as e:
+        return credentials_busy_response(e)
+
     new_user = User(
         username=username,
-        password_hash=generate_password_hash(password),
+        password_hash=password_hash,
         classroom_id=assigned_class_id,
         role=role  # <--- SAVE THE ROLE HERE
     )
     db.session.add(new_user)
     db.session.commit()
+    leaderboard.record_xp(new_user.id, new_user.classroom_id, 0, 0)
 
     return jsonify({"message": "User created", "username": username}), 201
 
@@ -298,10 +727,33 @@ def login():
     username = data.get("username", "").strip().lower()
     password = data.get("password", "")
 
+    retry_after = auth_ip_limiter.retry_after(request.remote_addr)
+    if retry_after:
+        return too_many_attempts(retry_after, "address")
+    retry_after = login_failure_limiter.retry_after(username)
+    if retry_after:
+        return too_many_attempts(retry_after, "username")
+    auth_ip_limiter.hit(request.remote_addr)
+
     user = User.query.filter_by(username=username).first()
 
-    if not user or not check_password_hash(user.password_hash, password):
+    try:
+        matches, needs_rehash = password_hasher.verify(user.password_hash, password) if user else (False, False)
+    except CredentialsBusy as e:
+        return credentials_busy_response(e)
+
+    if not matches:
+        login_failure_limiter.hit(username)
         return jsonify({"error": "Invalid credentials"}), 401
+    login_failure_limiter.reset(username)
+
+    if needs_rehash:
+        # Hashed with older parameters; upgrade while the password is at hand.
+        try:
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+        except CredentialsBusy:
+            pass
 
     token = create_access_token(identity=str(user.id))
 
@@ -318,155 +770,346 @@ def login():
 @app.route("/chat/start/random", methods=["POST"])
 @jwt_required()
 def start_random_chat():
-    current_user_id = get_jwt_identity()
-    disease = Disease.query.order_by(func.random()).first()
+    # Optional body: {"mode": "adaptive" | "uniform", "category": "<name>"}
+    user_id = current_user_id()
+    data = request.get_json(silent=True) or {}
+    mode = data.get("mode")
+    if mode not in (None, "adaptive", "uniform"):
+        return jsonify({"error": "Unknown selection mode"}), 400
+
+    category_stats = {}
+    disease_stats = {}
+    recent_ids = ()
+    if (mode or case_scheduler.mode) == "adaptive":
+        category_stats = {
+            category: (completed, correct)
+            for category, completed, correct in db.session.query(
+                UserCategoryStats.category, UserCategoryStats.cases_completed, UserCategoryStats.cases_correct
+            ).filter_by(user_id=user_id)
+        }
+        disease_stats = {
+            disease_id: (completed, correct)
+            for disease_id, completed, correct in db.session.query(
+                UserDiseaseStats.disease_id, UserDiseaseStats.cases_completed, UserDiseaseStats.cases_correct
+            ).filter_by(user_id=user_id)
+        }
+        # Walks ix_chat_session_user_start backwards, so it stays a short
+        # read however long the student's history is.
+        recent_ids = {disease_id for (disease_id,) in db.session.query(ChatSession.disease_id).filter_by(
+            user_id=user_id
+        ).order_by(ChatSession.start_time.desc(), ChatSession.id.desc()).limit(app.config['CASE_RECENT_WINDOW'])}
+
+    category = data.get("category")
+    disease = case_scheduler.pick(category_stats, recent_ids, mode=mode, category=category, disease_stats=disease_stats)
+    if not disease and category:
+        return jsonify({"error": "No cases in this category"}), 404
     if not disease:
         return jsonify({"error": "No diseases in database"}), 500
+    disease_id, disease_name, _ = disease
 
-    new_session = ChatSession(user_id=current_user_id, disease_id=disease.id)
+    new_session = ChatSession(user_id=user_id, disease_id=disease_id)
     db.session.add(new_session)
+    db.session.flush()
+    session_id = new_session.id  # read before the commit expires the row
     db.session.commit()
 
-    print("New chat session started:", new_session.id, "Disease:", disease.name)
+    print("New chat session started:", session_id, "Disease:", disease_name)
     return jsonify({
         "ok": True,
-        "session_id": new_session.id,
+        "session_id": session_id,
         "message": "** The patient has entered the office. **"
     })
 
+def stored_message_count(session_id):
+    # Messages saved to the DB plus those this process still buffers. A row
+    # written while this runs may be counted twice, which at worst costs one
+    # extra rebuild.
+    pending = len(chat_writer.pending_for(session_id)) if chat_writer else 0
+    return db.session.query(func.count(ChatMessage.id)).filter_by(session_id=session_id).scalar() + pending
+
+def load_session_context(session):
+    context = context_store.get(session.id)
+    if context is not None:
+        return context
+
+    message_count = stored_message_count(session.id) if app.config['CONTEXT_STORE_VERIFY'] else None
+    window = app.config['CONTEXT_WINDOW_MESSAGES']
+    recent_msgs = ChatMessage.query.filter_by(session_id=session.id).order_by(ChatMessage.timestamp.desc()).limit(window).all()
+    recent_msgs.reverse()
+    messages = [(msg.timestamp, msg.sender, msg.content) for msg in recent_msgs]
+    if chat_writer:
+        # Messages still in the write-behind buffer; a row written between
+        # the query and this check would otherwise show up twice.
+        stored = set(messages)
+        messages += [(row["timestamp"], row["sender"], row["content"]) for row in chat_writer.pending_for(session.id)
+                     if (row["timestamp"], row["sender"], row["content"]) not in stored]
+        messages = sorted(messages, key=lambda message: message[0])[-window:]
+
+    context = SessionContext(
+        session.id, session.user_id, session.disease_id, disease_registry.get(session.disease_id).system_prompt,
+        [{"role": "user" if sender == "student" else "assistant", "content": content} for _, sender, content in messages],
+        window=window,
+        message_count=message_count
+    )
+    context_store.put(context)
+    return context
+
+def cached_reply_key(context, data, messages):
+    # Students can opt out with {"no_cache": true} or "Cache-Control: no-cache".
+    if not response_cache.enabled or data.get("no_cache") or "no-cache" in request.headers.get("Cache-Control", ""):
+        return None
+    return response_cache.make_key(context.disease_id, messages[-1]["content"], messages[1:-1])
+
+def save_messages(session_id, messages):
+    # messages: [(sender, content)], stored in order.
+    if chat_writer:
+        for sender, content in messages:
+            chat_writer.enqueue(session_id, sender, content)
+    else:
+        for sender, content in messages:
+            db.session.add(ChatMessage(session_id=session_id, sender=sender, content=content))
+        db.session.commit()
+    for sender, content in messages:
+        context_store.append(session_id, "user" if sender == "student" else "assistant", content)
+
+def save_student_message(session_id, user_message):
+    save_messages(session_id, [("student", user_message)])
+
+def save_patient_reply(session_id, bot_reply):
+    save_messages(session_id, [("patient", bot_reply)])
+
+def save_turn(session_id, user_message, bot_reply):
+    save_messages(session_id, [("student", user_message), ("patient", bot_reply)])
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+def gateway_error_response(error):
+    llm_errors.inc(kind=type(error).__name__)
+    if isinstance(error, (GatewayBusy, GatewayUnavailable)):
+        response = jsonify({"error": str(error)})
+        response.headers["Retry-After"] = str(error.retry_after)
+        return response, 429 if isinstance(error, GatewayBusy) else 503
+    if isinstance(error, GatewayTimeout):
+        return jsonify({"error": str(error)}), 504
+    if isinstance(error, LLMError):
+        return jsonify({"error": str(error)}), 502
+    return jsonify({"error": str(error)}), 500
+
 @app.route("/chat", methods=["POST"])
 @jwt_required()
 def chat():
     data = request.get_json()
     session_id = data.get("session_id")
     user_message = data.get("message", "")
+    if not isinstance(user_message, str):
+        return jsonify({"error": "Message must be a string"}), 400
 
-    session = ChatSession.query.filter_by(id=session_id).first()
-    if not session:
+    context = load_owned_context(session_id)
+    if not context:
         return jsonify({"error": "Invalid session"}), 404
 
-    db.session.add(ChatMessage(session_id=session.id, sender="student", content=user_message))
-    db.session.commit()
+    payload = context_builder.build_payload(context.system_prompt, context.history(), user_message)
 
-    recent_msgs = ChatMessage.query.filter_by(session_id=session.id).order_by(ChatMessage.timestamp.desc()).limit(10).all()
-    recent_msgs.reverse()
+    cache_key = cached_reply_key(context, data, payload["messages"])
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            save_turn(context.session_id, user_message, cached)
+            return jsonify({"reply": cached, "cached": True})
 
-    conversation_history = [{"role": "system", "content": session.disease.system_prompt}]
-    for msg in recent_msgs:
-        role = "user" if msg.sender == "student" else "assistant"
-        conversation_history.append({"role": role, "content": msg.content})
+    # Take a place in the LLM queue first, so a busy model is reported
+    # before the student's message is stored.
+    try:
+        reservation = llm_gateway.reserve()
+    except GatewayBusy as e:
+        return gateway_error_response(e)
 
-    payload = {
-        "messages": conversation_history,
-        "max_new_tokens": 150,
-        "temperature": 0.2
-    }
+    with reservation:
+        save_student_message(context.session_id, user_message)
+
+        try:
+            bot_reply = reservation.generate(payload)
+        except Exception as e:
+            return gateway_error_response(e)
+
+    save_patient_reply(context.session_id, bot_reply)
+    llm_tokens_out.observe(context_builder.estimator(bot_reply))
+    if cache_key:
+        response_cache.put(cache_key, bot_reply)
+    return jsonify({"reply": bot_reply})
+
+@app.route("/chat/stream", methods=["POST"])
+@jwt_required()
+def chat_stream():
+    # Same contract as /chat, but relays the reply as server-sent events:
+    #   data: {"token": "..."}            for every chunk from the generator
+    #   event: done  data: {"reply": ...} once the reply is complete and saved
+    #   event: error data: {"error": ...} if the generator fails mid-stream
+    data = request.get_json()
+    session_id = data.get("session_id")
+    user_message = data.get("message", "")
+    if not isinstance(user_message, str):
+        return jsonify({"error": "Message must be a string"}), 400
+
+    context = load_owned_context(session_id)
+    if not context:
+        return jsonify({"error": "Invalid session"}), 404
+
+    payload = context_builder.build_payload(context.system_prompt, context.history(), user_message)
+    chat_session_id = context.session_id
+
+    cache_key = cached_reply_key(context, data, payload["messages"])
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            save_turn(chat_session_id, user_message, cached)
+
+            def replay():
+                yield sse_event({"token": cached})
+                yield sse_event({"reply": cached, "cached": True}, event="done")
+            return sse_response(replay())
 
     try:
-        response = requests.post(HF_URL, json=payload, headers=HF_HEADERS, timeout=120)
-        if response.status_code == 200:
-            ai_data = response.json()
-            bot_reply = ai_data.get("generated_text", "")
-            db.session.add(ChatMessage(session_id=session.id, sender="patient", content=bot_reply))
-            db.session.commit()
-            return jsonify({"reply": bot_reply})
-        else:
-            return jsonify({"error": f"LLM Error: {response.status_code}"}), 500
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-# --- CORE BADGE LOGIC HERE ---
-def check_and_award_badge(user, badge_name, xp_bonus=0):
-    existing_badge = UserBadge.query.filter_by(user_id=user.id, badge_name=badge_name).first()
-    if not existing_badge:
-        db.session.add(UserBadge(user_id=user.id, badge_name=badge_name))
-        user.xp += xp_bonus
-        return f" [BADGE: {badge_name}]"
-    return ""
+        reservation = llm_gateway.reserve()
+    except GatewayBusy as e:
+        return gateway_error_response(e)
+
+    try:
+        save_student_message(chat_session_id, user_message)
+    except Exception:
+        reservation.release()
+        raise
+
+    def generate():
+        parts = []
+        try:
+            for token in reservation.stream(payload):
+                if token:
+                    parts.append(token)
+                    yield sse_event({"token": token})
+        except Exception as e:
+            llm_errors.inc(kind=type(e).__name__)
+            yield sse_event({"error": str(e)}, event="error")
+            return
+
+        bot_reply = "".join(parts)
+        save_patient_reply(chat_session_id, bot_reply)
+        llm_tokens_out.observe(context_builder.estimator(bot_reply))
+        if cache_key:
+            response_cache.put(cache_key, bot_reply)
+        yield sse_event({"reply": bot_reply}, event="done")
+
+    response = sse_response(generate())
+    # Covers clients that disconnect before the stream is consumed.
+    response.call_on_close(reservation.release)
+    return response
+
+# --- USER STATS ---
+def get_user_stats(user_id):
+    # Loads the running counters, backfilling them from the session history
+    # the first time a user is seen (e.g. accounts created before the counters).
+    # Returns (stats, backfilled). The backfill is left for the caller to
+    # commit; if a concurrent request stored it first, theirs is used.
+    stats = db.session.get(UserStats, user_id)
+    if stats is not None:
+        return stats, False
+
+    correct_expr = func.coalesce(func.sum(case((ChatSession.was_correct == True, 1), else_=0)), 0)
+    completed, correct = db.session.query(func.count(ChatSession.id), correct_expr).filter(
+        ChatSession.user_id == user_id,
+        ChatSession.is_completed == True
+    ).one()
+    per_category = db.session.query(Disease.category, func.count(ChatSession.id), correct_expr).join(
+        Disease, ChatSession.disease_id == Disease.id
+    ).filter(
+        ChatSession.user_id == user_id,
+        ChatSession.is_completed == True
+    ).group_by(Disease.category).all()
+    try:
+        with db.session.begin_nested():
+            stats = UserStats(user_id=user_id, cases_completed=completed, cases_correct=correct)
+            db.session.add(stats)
+            for category, cat_completed, cat_correct in per_category:
+                if db.session.get(UserCategoryStats, (user_id, category)) is None:
+                    db.session.add(UserCategoryStats(user_id=user_id, category=category, cases_completed=cat_completed, cases_correct=cat_correct))
+    except IntegrityError:
+        return db.session.get(UserStats, user_id), False
+    return stats, True
+
+def get_category_stats(user_id, category):
+    stats = db.session.get(UserCategoryStats, (user_id, category))
+    if stats is not None:
+        return stats
+    try:
+        with db.session.begin_nested():
+            stats = UserCategoryStats(user_id=user_id, category=category, cases_completed=0, cases_correct=0)
+            db.session.add(stats)
+    except IntegrityError:
+        stats = db.session.get(UserCategoryStats, (user_id, category))
+    return stats
 
 @app.route("/chat/diagnose", methods=["POST"])
 @jwt_required()
 def check_diagnosis():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
     data = request.get_json()
     session_id = data.get("session_id")
-    student_diagnosis = data.get("diagnosis", "").strip().lower()
+    student_diagnosis = data.get("diagnosis", "")
 
-    session = ChatSession.query.filter_by(id=session_id, user_id=current_user_id).first()
+    session = load_owned_session(session_id, with_user=True)
     if not session:
         return jsonify({"error": "Session not found"}), 404
-
-    correct_name = session.disease.name.lower()
-    is_correct = correct_name in student_diagnosis
-
-    xp_gained = 0
-    message = ""
-    badge_alerts = ""
+    user = current_user()
+
+    disease = disease_registry.get(session.disease_id)
+    match = get_diagnosis_matcher().match(student_diagnosis)
+    # A match below the threshold is graded (and counted) as matching nothing.
+    confident = match is not None and match.confidence >= app.config['DIAGNOSIS_MATCH_THRESHOLD']
+    matched_disease_id = match.disease_id if confident else UNMATCHED
+    is_correct = matched_disease_id == disease.id
+    now = datetime.datetime.utcnow()
+
+    # Counters only move the first time a session is completed / found correct.
+    stats, _ = get_user_stats(user.id)
+    category_stats = get_category_stats(user.id, disease.category)
+    first_completion = not session.is_completed
+    first_correct = is_correct and not session.was_correct
+    if first_completion:
+        stats.cases_completed += 1
+        category_stats.cases_completed += 1
+    if first_correct:
+        stats.cases_correct += 1
+        category_stats.cases_correct += 1
+
+    if first_completion:
+        session.submitted_diagnosis = student_diagnosis[:500]
+        session.matched_disease_id = matched_disease_id
+        session.question_count = count_questions(session.id)
+        session.end_time = now
+    if first_completion or first_correct:
+        bump_counters(UserDiseaseStats, {"user_id": user.id, "disease_id": session.disease_id},
+                      {"cases_completed": int(first_completion), "cases_correct": int(first_correct)})
+    if user.classroom_id is not None and (first_completion or first_correct):
+        record_classroom_case(user.classroom_id, session, first_completion, first_correct)
 
     if is_correct:
         xp_gained = 100
         session.was_correct = True
         user.consecutive_correct += 1 # Increment streak
-        message = f"Correct! The diagnosis was {session.disease.name}."
-
-        # 1. BADGE: Speed Demon (< 2 mins)
-        duration = (datetime.datetime.utcnow() - session.start_time).total_seconds()
-        if duration < 120:
-            badge_alerts += check_and_award_badge(user, "Speed Demon", 100)
-
-        # 2. BADGE: Perfect Ten (10 correct in a row)
-        if user.consecutive_correct >= 10:
-            badge_alerts += check_and_award_badge(user, "Perfect Ten", 300)
-
-        # 3. BADGE: Endodontist Expert (20 Pulp-related)
-        if session.disease.category == 'Pulpal':
-            # Count previous correct pulpal cases
-            # Note: This query is a bit complex for SQLite in raw SQLAlchemy without joins, simplified here:
-            pulpal_count = ChatSession.query.join(Disease).filter(
-                ChatSession.user_id==user.id,
-                ChatSession.was_correct==True,
-                Disease.category=='Pulpal'
-            ).count()
-            # +1 because the current session isn't committed yet
-            if pulpal_count + 1 >= 20:
-                badge_alerts += check_and_award_badge(user, "Endodontist Expert", 500)
-
-        # 4. BADGE: Periodontal Pro (20 Perio-related)
-        if session.disease.category == 'Periodontal':
-            perio_count = ChatSession.query.join(Disease).filter(
-                ChatSession.user_id==user.id,
-                ChatSession.was_correct==True,
-                Disease.category=='Periodontal'
-            ).count()
-            if perio_count + 1 >= 20:
-                badge_alerts += check_and_award_badge(user, "Periodontal Pro", 500)
-
+        message = f"Correct! The diagnosis was {disease.name}."
     else:
         xp_gained = 20
         user.consecutive_correct = 0 # Reset streak
-        message = f"Incorrect. The correct diagnosis was {session.disease.name}. (+20 XP for effort)"
-
-    # --- GLOBAL BADGES (Correct or Incorrect) ---
-
-    # 5. BADGE: First Steps (First case completed)
-    badge_alerts += check_and_award_badge(user, "First Steps", 50)
-
-    # 6. BADGE: Master Diagnostician (100 total cases)
-    total_cases = ChatSession.query.filter_by(user_id=user.id, is_completed=True).count()
-    if total_cases + 1 >= 100:
-        badge_alerts += check_and_award_badge(user, "Master Diagnostician", 2000)
-
-    # 7. BADGE: Early Bird (Before 7 AM server time)
-    current_hour = datetime.datetime.utcnow().hour
-    if current_hour < 7:
-        badge_alerts += check_and_award_badge(user, "Early Bird", 25)
+        message = f"Incorrect. The correct diagnosis was {disease.name}. (+20 XP for effort)"
 
-    # 8. BADGE: Night Owl (After 11 PM server time)
-    if current_hour >= 23:
-        badge_alerts += check_and_award_badge(user, "Night Owl", 25)
-
-    # --- STREAK LOGIC & BADGES ---
+    # --- STREAK LOGIC ---
     today = datetime.date.today()
     if user.last_active_date != today:
         yesterday = today - datetime.timedelta(days=1)
@@ -476,48 +1119,74 @@ def check_diagnosis():
             user.streak = 1
         user.last_active_date = today
 
-    # 9. BADGE: Week Warrior (7 day streak)
-    if user.streak >= 7:
-        badge_alerts += check_and_award_badge(user, "Week Warrior", 150)
-
-    # 10. BADGE: Monthly Master (30 day streak)
-    if user.streak >= 30:
-        badge_alerts += check_and_award_badge(user, "Monthly Master", 1000)
+    # --- BADGES ---
+    badge_context = BadgeContext(
+        is_correct=is_correct,
+        duration_seconds=(now - session.start_time).total_seconds(),
+        category=disease.category,
+        consecutive_correct=user.consecutive_correct,
+        cases_completed=stats.cases_completed,
+        category_correct=category_stats.cases_correct,
+        streak=user.streak,
+        hour=now.hour
+    )
+    earned_names = {name for (name,) in db.session.query(UserBadge.badge_name).filter_by(user_id=user.id)}
+    awarded = []
+    for rule in evaluate_badges(badge_context, earned_names):
+        # A concurrent diagnosis may have awarded it first; it pays out once.
+        try:
+            with db.session.begin_nested():
+                db.session.add(UserBadge(user_id=user.id, badge_name=rule.name))
+            awarded.append(rule)
+        except IntegrityError:
+            pass
+    new_badges = awarded
+    badge_xp = sum(rule.xp_bonus for rule in new_badges)
+    badge_alerts = "".join(f" [BADGE: {rule.name}]" for rule in new_badges)
 
     # Finalize
-    user.xp += xp_gained
+    user.xp += xp_gained + badge_xp
+    db.session.add(XpEvent(user_id=user.id, amount=xp_gained + badge_xp, created_at=now))
     session.is_completed = True
-    session.end_time = datetime.datetime.utcnow()
+    # Read before the commit expires the rows, which would reload them.
+    user_id, classroom_id, total_xp, chat_session_id = user.id, user.classroom_id, user.xp, session.id
     db.session.commit()
+    context_store.evict(chat_session_id)
+    leaderboard.record_xp(user_id, classroom_id, total_xp, xp_gained + badge_xp)
 
     return jsonify({
         "correct": is_correct,
         "message": message + badge_alerts,
         "xp_gained": xp_gained,
-        "correct_diagnosis": session.disease.name
+        "correct_diagnosis": disease.name,
+        "matched_diagnosis": match.name if match else None,
+        "match_confidence": match.confidence if match else 0.0
     })
 
 @app.route("/auth/profile", methods=["GET"])
 @jwt_required()
 def get_profile():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
+    user = current_user()
 
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    completed_sessions = [s for s in user.sessions if s.is_completed]
-    total_cases = len(completed_sessions)
-    correct_cases = len([s for s in completed_sessions if s.was_correct])
+    stats, backfilled = get_user_stats(user.id)
+    if backfilled:
+        db.session.commit()
+    total_cases = stats.cases_completed
 
     accuracy = 0
     if total_cases > 0:
-        accuracy = int((correct_cases / total_cases) * 100)
+        accuracy = int((stats.cases_correct / total_cases) * 100)
 
-    rank = User.query.filter(User.xp > user.xp).count() + 1
-    earned_badge_names = [b.badge_name for b in user.badges]
+    rank = leaderboard.rank(user.id)
+    if rank is None:
+        # Registered through another worker since the board was last loaded.
+        rank = User.query.filter(User.xp > user.xp).count() + 1
+    earned_badge_names = [name for (name,) in db.session.query(UserBadge.badge_name).filter_by(user_id=user.id).order_by(UserBadge.id)]
 
-    return jsonify({
+    response = jsonify({
         "username": user.username,
         "xp": user.xp,
         "cases_completed": total_cases,
@@ -528,12 +1197,15 @@ def get_profile():
         "rank": rank,
         "role": user.role
     })
+    # The pages poll this on every view; unchanged profiles revalidate to a 304.
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 @app.route("/auth/update-profile", methods=["PUT"])
 @jwt_required()
 def update_profile():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
+    user = current_user()
     data = request.get_json()
 
     new_username = data.get("username", "").strip()
@@ -552,33 +1224,481 @@ def update_profile():
     return jsonify({"message": "Profile updated successfully"})
 
 @app.route("/auth/leaderboard", methods=["GET"])
+@jwt_required(optional=True)
 def get_leaderboard():
-    top_users = User.query.order_by(User.xp.desc()).limit(50).all()
+    # ?period=all|weekly, ?classroom_id=<id> (or ?scope=classroom for the
+    # caller's own class), ?limit=<n> (max 200).
+    period = request.args.get("period", "all")
+    limit = min(request.args.get("limit", 50, type=int), 200)
+    classroom_id = request.args.get("classroom_id", type=int)
+    if classroom_id is None and request.args.get("scope") == "classroom":
+        user_id = current_user_id()
+        if not user_id:
+            return jsonify({"error": "Login required for classroom leaderboard"}), 401
+        classroom_id = db.session.query(User.classroom_id).filter_by(id=user_id).scalar()
+        if classroom_id is None:
+            return jsonify([])
+
+    entries = leaderboard.top(limit, period=period, classroom_id=classroom_id)
+    users = {u.id: u for u in User.query.filter(User.id.in_([user_id for user_id, _ in entries])).all()}
+
     leaderboard_data = []
-    for index, u in enumerate(top_users):
-        leaderboard_data.append({
+    for index, (user_id, score) in enumerate(entries):
+        u = users.get(user_id)
+        if not u:
+            continue
+        row = {
             "id": u.id,
             "username": u.username,
             "xp": u.xp,
             "streak": u.streak,
             "rank": index + 1,
             "level": int(u.xp / 1000) + 1
-        })
+        }
+        if period == "weekly":
+            row["weekly_xp"] = score
+        leaderboard_data.append(row)
     return jsonify(leaderboard_data)
 
+# --- HISTORY ---
+# Keyset pagination: each page carries an opaque cursor naming the last row
+# seen, and the next page starts strictly after it, so pages stay cheap and
+# stable however far back a student scrolls.
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get("HISTORY_PAGE_SIZE", 20))
+app.config['HISTORY_MAX_PAGE_SIZE'] = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 100))
+
+def encode_cursor(timestamp, row_id):
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    # -> (timestamp, id); raises ValueError on anything malformed.
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    payload = json.loads(raw)
+    if (not isinstance(payload, list) or len(payload) != 2
+            or not isinstance(payload[0], (str, type(None))) or not isinstance(payload[1], int)):
+        raise ValueError("Malformed cursor")
+    timestamp, row_id = payload
+    return (datetime.datetime.fromisoformat(timestamp) if timestamp else None), int(row_id)
+
+def page_size():
+    return max(1, min(request.args.get("limit", app.config['HISTORY_PAGE_SIZE'], type=int), app.config['HISTORY_MAX_PAGE_SIZE']))
+
+def parse_flag(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return value.lower() in ("1", "true", "yes")
+
+@app.route("/history/sessions", methods=["GET"])
+@jwt_required()
+def list_history_sessions():
+    # Newest first. ?limit=<n>, ?cursor=<next_cursor>, ?disease_id=<id>,
+    # ?category=<name>, ?correct=true|false, ?completed=true|false
+    limit = page_size()
+    query = ChatSession.query.filter(ChatSession.user_id == current_user_id())
+
+    # Disease filters only match completed cases; on open ones they would
+    # reveal the hidden diagnosis.
+    disease_id = request.args.get("disease_id", type=int)
+    if disease_id is not None:
+        query = query.filter(ChatSession.is_completed == True, ChatSession.disease_id == disease_id)
+    category = request.args.get("category")
+    if category:
+        # Resolved through the registry so no join with disease is needed.
+        query = query.filter(ChatSession.is_completed == True,
+                             ChatSession.disease_id.in_([d.id for d in disease_registry.all() if d.category == category]))
+    correct = parse_flag("correct")
+    if correct is not None:
+        query = query.filter(ChatSession.is_completed == True, ChatSession.was_correct == correct)
+    completed = parse_flag("completed")
+    if completed is not None:
+        query = query.filter(ChatSession.is_completed == completed)
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            after_time, after_id = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        query = query.filter(tuple_(ChatSession.start_time, ChatSession.id) < (after_time, after_id))
+
+    sessions = query.order_by(ChatSession.start_time.desc(), ChatSession.id.desc()).limit(limit + 1).all()
+    has_more = len(sessions) > limit
+    sessions = sessions[:limit]
+
+    message_counts = dict(db.session.query(ChatMessage.session_id, func.count(ChatMessage.id)).filter(
+        ChatMessage.session_id.in_([session.id for session in sessions])
+    ).group_by(ChatMessage.session_id).all()) if sessions else {}
+
+    items = []
+    for session in sessions:
+        disease = disease_registry.get(session.disease_id)
+        items.append({
+            "id": session.id,
+            "disease_id": session.disease_id if session.is_completed else None,
+            # Open cases keep their diagnosis hidden.
+            "disease": disease.name if session.is_completed and disease else None,
+            "category": disease.category if session.is_completed and disease else None,
+            "start_time": session.start_time.isoformat() if session.start_time else None,
+            "end_time": session.end_time.isoformat() if session.end_time else None,
+            "is_completed": session.is_completed,
+            "was_correct": session.was_correct,
+            "message_count": message_counts.get(session.id, 0)
+        })
+    last = sessions[-1] if sessions else None
+    return jsonify({
+        "sessions": items,
+        "next_cursor": encode_cursor(last.start_time, last.id) if has_more else None
+    })
+
+@app.route("/history/sessions/<int:session_id>/messages", methods=["GET"])
+@jwt_required()
+def list_history_messages(session_id):
+    # Oldest first. ?limit=<n>, ?cursor=<next_cursor>
+    if not load_owned_session(session_id):
+        return jsonify({"error": "Session not found"}), 404
+
+    limit = page_size()
+    query = ChatMessage.query.filter(ChatMessage.session_id == session_id)
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            after_time, after_id = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        query = query.filter(tuple_(ChatMessage.timestamp, ChatMessage.id) > (after_time, after_id))
+
+    messages = query.order_by(ChatMessage.timestamp, ChatMessage.id).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    items = [{"id": m.id, "sender": m.sender, "content": m.content, "timestamp": m.timestamp.isoformat()} for m in messages]
+    if chat_writer and not has_more:
+        # The last page also shows turns still waiting in the write-behind buffer.
+        stored = {(m.timestamp, m.sender, m.content) for m in messages}
+        items += [{"id": None, "sender": row["sender"], "content": row["content"], "timestamp": row["timestamp"].isoformat()}
+                  for row in chat_writer.pending_for(session_id)
+                  if (row["timestamp"], row["sender"], row["content"]) not in stored]
+    last = messages[-1] if messages else None
+    return jsonify({
+        "messages": items,
+        "next_cursor": encode_cursor(last.timestamp, last.id) if has_more else None
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# --- ADMIN: DISEASE CATALOG ---
+def admin_required(view):
+    # Admin routes need "X-Admin-Token: <ADMIN_TOKEN>"; unset token = disabled.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['ADMIN_TOKEN']
+        if not token:
+            return jsonify({"error": "Admin API is disabled"}), 403
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            return jsonify({"error": "Invalid admin token"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/admin/diseases", methods=["GET"])
+@admin_required
+def list_diseases():
+    return jsonify([{
+        "id": d.id,
+        "name": d.name,
+        "category": d.category,
+        "prompt_version": d.prompt_version,
+        "synonyms": d.synonyms
+    } for d in disease_registry.all()])
+
+@app.route("/admin/diseases/<int:disease_id>", methods=["PUT"])
+@admin_required
+def edit_disease(disease_id):
+    disease = db.session.get(Disease, disease_id)
+    if not disease:
+        return jsonify({"error": "Disease not found"}), 404
+
+    data = request.get_json()
+    update_disease(
+        disease,
+        name=data.get("name", "").strip(),
+        category=data.get("category", "").strip(),
+        system_prompt=data.get("system_prompt", "").strip(),
+        synonyms=data.get("synonyms")
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "Disease name already exists"}), 409
+
+    disease_registry.invalidate()
+    entry = disease_registry.get(disease_id)
+    return jsonify({"id": entry.id, "name": entry.name, "category": entry.category, "prompt_version": entry.prompt_version, "synonyms": entry.synonyms})
+
+@app.route("/admin/diseases/reload", methods=["POST"])
+@admin_required
+def reload_diseases():
+    changed = sync_disease_catalog(app.config['DISEASE_CATALOG_PATH'], force=True)
+    disease_registry.invalidate()
+    return jsonify({"changed": changed, "diseases": len(disease_registry.all())})
+
+# --- ADMIN: MODEL ENDPOINTS ---
+@app.route("/admin/llm/endpoints", methods=["GET"])
+@admin_required
+def list_model_endpoints():
+    return jsonify({
+        "endpoints": model_router.snapshot(),
+        "retries": model_router.retries,
+        "hedges": model_router.hedges
+    })
+
+# --- ADMIN: CLASSROOM ANALYTICS ---
+# Reports read the running totals kept by record_classroom_case(), which
+# counts each case once: time and questions at its first diagnosis, the
+# confusion matrix from the first answer, correctness once it is found.
+# ?source=live recomputes the same numbers from the sessions instead, and
+# the rebuild route rewrites the totals from that recomputation.
+def count_questions(session_id):
+    count = db.session.query(func.count(ChatMessage.id)).filter_by(session_id=session_id, sender="student").scalar()
+    if chat_writer:
+        count += sum(1 for row in chat_writer.pending_for(session_id) if row["sender"] == "student")
+    return count
+
+def bump_counters(model, key, increments):
+    # Atomic "UPDATE ... SET n = n + x", inserting the row the first time;
+    # concurrent diagnoses in one class share these rows.
+    values = {getattr(model, name): getattr(model, name) + amount for name, amount in increments.items()}
+    if db.session.query(model).filter_by(**key).update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**key, **increments))
+    except IntegrityError:
+        db.session.query(model).filter_by(**key).update(values, synchronize_session=False)
+
+def record_classroom_case(classroom_id, session, first_completion, first_correct):
+    key = {"classroom_id": classroom_id, "disease_id": session.disease_id}
+    increments = {"cases_correct": int(first_correct)}
+    if first_completion:
+        increments.update(
+            cases_completed=1,
+            total_seconds=(session.end_time - session.start_time).total_seconds(),
+            total_questions=session.question_count or 0
+        )
+        bump_counters(ClassroomConfusion, dict(key, matched_disease_id=session.matched_disease_id), {"count": 1})
+    bump_counters(ClassroomDiseaseStats, key, increments)
+
+def compute_classroom_totals(classroom_id):
+    rows = db.session.query(
+        ChatSession.disease_id, ChatSession.was_correct, ChatSession.start_time, ChatSession.end_time,
+        ChatSession.question_count, ChatSession.matched_disease_id
+    ).join(User, User.id == ChatSession.user_id).filter(
+        User.classroom_id == classroom_id, ChatSession.is_completed == True
+    ).all()
+    return aggregate(
+        [row.disease_id for row in rows],
+        [row.was_correct for row in rows],
+        [(row.end_time - row.start_time).total_seconds() if row.end_time and row.start_time else 0.0 for row in rows],
+        [row.question_count for row in rows],
+        [row.matched_disease_id for row in rows]
+    )
+
+def load_classroom_totals(classroom_id):
+    totals = {
+        row.disease_id: DiseaseTotals(row.cases_completed, row.cases_correct, row.total_seconds, row.total_questions)
+        for row in ClassroomDiseaseStats.query.filter_by(classroom_id=classroom_id)
+    }
+    confusion = {
+        (row.disease_id, row.matched_disease_id): row.count
+        for row in ClassroomConfusion.query.filter_by(classroom_id=classroom_id)
+    }
+    return totals, confusion
+
+def rebuild_classroom_totals(classroom_id):
+    totals, confusion = compute_classroom_totals(classroom_id)
+    ClassroomDiseaseStats.query.filter_by(classroom_id=classroom_id).delete()
+    ClassroomConfusion.query.filter_by(classroom_id=classroom_id).delete()
+    db.session.add_all([
+        ClassroomDiseaseStats(classroom_id=classroom_id, disease_id=disease_id, cases_completed=t.completed,
+                              cases_correct=t.correct, total_seconds=t.seconds, total_questions=t.questions)
+        for disease_id, t in totals.items()
+    ])
+    db.session.add_all([
+        ClassroomConfusion(classroom_id=classroom_id, disease_id=disease_id, matched_disease_id=matched, count=count)
+        for (disease_id, matched), count in confusion.items()
+    ])
+    db.session.commit()
+    return sum(t.completed for t in totals.values())
+
+@app.route("/admin/classrooms/<int:classroom_id>/analytics", methods=["GET"])
+@admin_required
+def classroom_analytics(classroom_id):
+    # ?source=rollup (default) | live
+    classroom = db.session.get(Classroom, classroom_id)
+    if not classroom:
+        return jsonify({"error": "Classroom not found"}), 404
+    source = request.args.get("source", "rollup")
+    if source not in ("rollup", "live"):
+        return jsonify({"error": "Unknown source"}), 400
+
+    totals, confusion = compute_classroom_totals(classroom_id) if source == "live" else load_classroom_totals(classroom_id)
+    report = build_report(totals, confusion, {d.id: (d.name, d.category) for d in disease_registry.all()})
+    report.update(
+        classroom_id=classroom.id,
+        classroom=classroom.name,
+        students=db.session.query(func.count(User.id)).filter_by(classroom_id=classroom_id).scalar(),
+        source=source
+    )
+    return jsonify(report)
+
+@app.route("/admin/classrooms/<int:classroom_id>/analytics/rebuild", methods=["POST"])
+@admin_required
+def rebuild_classroom_analytics(classroom_id):
+    if not db.session.get(Classroom, classroom_id):
+        return jsonify({"error": "Classroom not found"}), 404
+    return jsonify({"classroom_id": classroom_id, "cases": rebuild_classroom_totals(classroom_id)})
+
+# --- ADMIN: TRANSCRIPT EXPORT ---
+# Streams transcripts row by row from a server-side cursor, so exporting a
+# whole classroom never holds more than one batch of rows in memory.
+EXPORT_BATCH_ROWS = 1000
+EXPORT_CSV_COLUMNS = ["session_id", "username", "disease", "category", "start_time", "end_time",
+                      "is_completed", "was_correct", "sender", "timestamp", "content"]
+
+@app.route("/admin/export/transcripts", methods=["GET"])
+@admin_required
+def export_transcripts():
+    # ?format=ndjson|csv, ?classroom_id=<id>, ?user_id=<id>,
+    # ?since=<ISO date>, ?until=<ISO date> (on the session start time)
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"error": "Unknown export format"}), 400
+
+    query = db.session.query(
+        ChatSession.id, User.username, ChatSession.disease_id, ChatSession.start_time, ChatSession.end_time,
+        ChatSession.is_completed, ChatSession.was_correct, ChatMessage.sender, ChatMessage.timestamp, ChatMessage.content
+    ).join(User, User.id == ChatSession.user_id).outerjoin(ChatMessage, ChatMessage.session_id == ChatSession.id)
+
+    classroom_id = request.args.get("classroom_id", type=int)
+    if classroom_id is not None:
+        query = query.filter(User.classroom_id == classroom_id)
+    user_id = request.args.get("user_id", type=int)
+    if user_id is not None:
+        query = query.filter(ChatSession.user_id == user_id)
+    try:
+        for name, op in (("since", ChatSession.start_time.__ge__), ("until", ChatSession.start_time.__lt__)):
+            if request.args.get(name):
+                query = query.filter(op(datetime.datetime.fromisoformat(request.args[name])))
+    except ValueError:
+        return jsonify({"error": "Dates must be ISO formatted"}), 400
+
+    if chat_writer:
+        chat_writer.flush(timeout=5)
+    # Resolved up front: nothing touches the registry while the cursor is open.
+    diseases = {d.id: (d.name, d.category) for d in disease_registry.all()}
+    rows = query.order_by(ChatSession.id, ChatMessage.timestamp, ChatMessage.id).execution_options(
+        yield_per=EXPORT_BATCH_ROWS
+    )
+
+    def session_fields(row):
+        name, category = diseases.get(row.disease_id, (None, None))
+        return {
+            "session_id": row.id,
+            "username": row.username,
+            "disease": name,
+            "category": category,
+            "start_time": row.start_time.isoformat() if row.start_time else None,
+            "end_time": row.end_time.isoformat() if row.end_time else None,
+            "is_completed": row.is_completed,
+            "was_correct": row.was_correct
+        }
+
+    def ndjson():
+        # One line per session, with its messages in order.
+        current = None
+        for row in rows:
+            if current is None or current["session_id"] != row.id:
+                if current is not None:
+                    yield json.dumps(current) + "\n"
+                current = dict(session_fields(row), messages=[])
+            if row.sender is not None:
+                current["messages"].append({"sender": row.sender, "timestamp": row.timestamp.isoformat(), "content": row.content})
+        if current is not None:
+            yield json.dumps(current) + "\n"
+
+    def csv_rows():
+        # One line per message.
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS)
+        writer.writeheader()
+        fields = None
+        for count, row in enumerate(rows, 1):
+            if fields is None or fields["session_id"] != row.id:
+                fields = session_fields(row)
+            writer.writerow(dict(fields, sender=row.sender, content=row.content,
+                                 timestamp=row.timestamp.isoformat() if row.timestamp else None))
+            if count % EXPORT_BATCH_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "text/csv"
+    body = ndjson() if export_format == "ndjson" else csv_rows()
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=transcripts.{export_format}"
+    })
+
+# --- STARTUP / SHUTDOWN ---
+# create_app() prepares the database (tables, migrations, disease catalog)
+# and returns the app; every worker process calls it. The work runs under a
+# lock shared by all workers (see process_lock.py) and each step is a no-op
+# once done, so only the first worker to start does anything.
+app.config['STARTUP_LOCK_PATH'] = os.environ.get("STARTUP_LOCK_PATH", os.path.join(app.instance_path, "startup.lock"))
+app.config['SHUTDOWN_DRAIN_SECONDS'] = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 30))
+
+_startup = {"done": False, "lock": threading.Lock()}
+
+def create_app():
+    with _startup["lock"]:
+        if not _startup["done"]:
+            with app.app_context():
+                with startup_lock(db.engine, app.config['STARTUP_LOCK_PATH']):
+                    db.create_all()
+                    run_migrations(db.engine, db.metadata)
+                    sync_disease_catalog(app.config['DISEASE_CATALOG_PATH'])
+            _startup["done"] = True
+    return app
+
+def shutdown(timeout=None):
+    # Lets admitted patient replies finish, then stops the background work.
+    timeout = app.config['SHUTDOWN_DRAIN_SECONDS'] if timeout is None else timeout
+    if not llm_gateway.drain(timeout):
+        print(f"Shutdown: patient replies still running after {timeout:g}s")
+    llm_gateway.close()
+    if chat_writer:
+        chat_writer.close()
+    password_hasher.close()
+
+@app.cli.command("migrate")
+def migrate_command():
+    db.create_all()
+    run_migrations(db.engine, db.metadata)
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics_command():
+    for (classroom_id,) in db.session.query(Classroom.id).all():
+        print(f"Classroom {classroom_id}: {rebuild_classroom_totals(classroom_id)} case(s)")
+
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
-        if DISEASE_DATA and not Disease.query.first():
-            print("Seeding database with diseases...")
-            for d in DISEASE_DATA:
-                db.session.add(Disease(
-                    name=d["name"],
-                    category=d.get("category", "General"),
-                    system_prompt=d["prompt"]
-                ))
-            db.session.commit()
-            print("Seeding complete.")
+    # Development server; production runs through serve.py.
+    create_app()
 
     print("Starting DentalSim Backend on port 8000...")
     app.run(host="0.0.0.0", port=9003, debug=True)
\ No newline at end of file
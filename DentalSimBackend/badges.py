@@ -0,0 +1,51 @@
+# --- BADGE RULES ---
+# Every badge is a rule over a snapshot of the student's counters taken right
+# after the diagnosis is scored. Rules only read that snapshot, so evaluating
+# all of them costs the same no matter how many cases the student has done.
+
+
+class BadgeContext:
+    def __init__(self, is_correct, duration_seconds, category, consecutive_correct,
+                 cases_completed, category_correct, streak, hour):
+        self.is_correct = is_correct
+        self.duration_seconds = duration_seconds
+        self.category = category
+        self.consecutive_correct = consecutive_correct
+        self.cases_completed = cases_completed
+        self.category_correct = category_correct
+        self.streak = streak
+        self.hour = hour
+
+
+class BadgeRule:
+    def __init__(self, name, xp_bonus, applies):
+        self.name = name
+        self.xp_bonus = xp_bonus
+        self.applies = applies
+
+
+# Evaluated in this order, which is also the order of the badge alerts.
+BADGE_RULES = [
+    # Correct diagnosis in under 2 minutes
+    BadgeRule("Speed Demon", 100, lambda c: c.is_correct and c.duration_seconds < 120),
+    # 10 correct in a row
+    BadgeRule("Perfect Ten", 300, lambda c: c.is_correct and c.consecutive_correct >= 10),
+    # 20 correct pulp-related cases
+    BadgeRule("Endodontist Expert", 500, lambda c: c.is_correct and c.category == 'Pulpal' and c.category_correct >= 20),
+    # 20 correct perio-related cases
+    BadgeRule("Periodontal Pro", 500, lambda c: c.is_correct and c.category == 'Periodontal' and c.category_correct >= 20),
+    # First case completed
+    BadgeRule("First Steps", 50, lambda c: True),
+    # 100 total cases
+    BadgeRule("Master Diagnostician", 2000, lambda c: c.cases_completed >= 100),
+    # Before 7 AM / after 11 PM server time
+    BadgeRule("Early Bird", 25, lambda c: c.hour < 7),
+    BadgeRule("Night Owl", 25, lambda c: c.hour >= 23),
+    # 7 and 30 day streaks
+    BadgeRule("Week Warrior", 150, lambda c: c.streak >= 7),
+    BadgeRule("Monthly Master", 1000, lambda c: c.streak >= 30),
+]
+
+
+def evaluate_badges(context, earned_names, rules=BADGE_RULES):
+    return [rule for rule in rules if rule.name not in earned_names and rule.applies(context)]
@@ -0,0 +1,88 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# --- MICRO-BATCHING ---
+# Collects generate requests that arrive within `window_ms` of each other
+# (up to `max_batch_size`) and hands them to `send_batch` as one call.
+# `send_batch(payloads)` must return one reply per payload, in order.
+# Batches are dispatched on a small pool so the next window can start
+# filling while the previous batch is still on the GPU.
+
+
+class MicroBatcher:
+    def __init__(self, send_batch, window_ms=10, max_batch_size=8, max_concurrent_batches=2):
+        self.send_batch = send_batch
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+
+        self.batches_sent = 0
+        self.items_sent = 0
+
+        self._queue = queue.Queue()
+        self._dispatch = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="llm-batch")
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect, name="llm-batch-collector", daemon=True)
+        self._collector.start()
+
+    def submit(self, payload):
+        if self._closed:
+            raise RuntimeError("Batcher is closed")
+        future = Future()
+        self._queue.put((payload, future))
+        return future
+
+    def average_batch_size(self):
+        if not self.batches_sent:
+            return 0.0
+        return self.items_sent / self.batches_sent
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._collector.join()
+        self._dispatch.shutdown(wait=True)
+
+    def _collect(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            window_end = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = window_end - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._dispatch.submit(self._send, batch)
+                    return
+                batch.append(item)
+
+            self._dispatch.submit(self._send, batch)
+
+    def _send(self, batch):
+        # Requests that gave up (deadline passed) are dropped from the batch.
+        batch = [(payload, future) for payload, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        self.batches_sent += 1
+        self.items_sent += len(batch)
+        try:
+            replies = self.send_batch([payload for payload, _ in batch])
+            if len(replies) != len(batch):
+                raise RuntimeError(f"Batch returned {len(replies)} replies for {len(batch)} requests")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), reply in zip(batch, replies):
+            future.set_result(reply)
@@ -0,0 +1,60 @@
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from batching import MicroBatcher
+from mock_llm import StubGenerator
+
+# Compares one-call-per-request against micro-batching on the stub generator.
+# Run from DentalSimBackend/:  python -m benchmarks.bench_batching
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(label, call, clients, requests_per_client):
+    latencies = []
+
+    def client(client_id):
+        for turn in range(requests_per_client):
+            payload = {"messages": [{"role": "user", "content": f"client {client_id} turn {turn}"}]}
+            started = time.perf_counter()
+            call(payload)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    elapsed = time.perf_counter() - started
+
+    print(f"{label:<28} {len(latencies) / elapsed:8.1f} req/s   "
+          f"p50 {percentile(latencies, 50) * 1000:7.1f} ms   "
+          f"p95 {percentile(latencies, 95) * 1000:7.1f} ms   "
+          f"mean {statistics.mean(latencies) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching throughput/latency benchmark")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=5, help="requests per client")
+    parser.add_argument("--base-latency-ms", type=float, default=100)
+    parser.add_argument("--per-item-ms", type=float, default=5)
+    parser.add_argument("--window-ms", type=float, nargs="+", default=[5, 10, 25])
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients x {args.requests} requests, "
+          f"stub: {args.base_latency_ms} ms/call + {args.per_item_ms} ms/extra item\n")
+
+    stub = StubGenerator(args.base_latency_ms, args.per_item_ms)
+    run("unbatched", stub.generate, args.clients, args.requests)
+
+    for window_ms in args.window_ms:
+        stub = StubGenerator(args.base_latency_ms, args.per_item_ms)
+        batcher = MicroBatcher(stub.generate_batch, window_ms=window_ms, max_batch_size=args.max_batch_size)
+        run(f"batched ({window_ms:g} ms window)", lambda p: batcher.submit(p).result(), args.clients, args.requests)
+        print(f"{'':<28} avg batch size {batcher.average_batch_size():.1f}, generator calls {stub.calls}")
+        batcher.close()
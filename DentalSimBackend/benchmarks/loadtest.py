@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+import requests
+from benchmarks.bench_batching import percentile
+
+# End-to-end load test: starts the stub generator (mock_llm.py) and the
+# backend against a throwaway SQLite database, then simulates classrooms of
+# students going through whole cases: register, login, start a random case,
+# a few chat turns, a diagnosis, then the profile and leaderboard polls the
+# pages make. Reports latency percentiles, throughput and error rate per
+# endpoint; --json writes the same numbers for comparing runs.
+#
+# Run from DentalSimBackend/:  python -m benchmarks.loadtest --students 40
+# Extra backend settings go through the environment, e.g.
+#   LLM_BATCH_WINDOW_MS=10 python -m benchmarks.loadtest --stream
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "What brings you in today?",
+    "Where exactly does it hurt?",
+    "How long have you had the pain?",
+    "Does it hurt when you drink something cold?",
+    "Does the pain wake you up at night?",
+    "Have you noticed any swelling?",
+    "Does it hurt when you bite down?",
+    "Is the pain sharp or dull?",
+]
+
+
+class Recorder:
+    def __init__(self):
+        self._samples = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self._samples[endpoint].append(seconds)
+            if not ok:
+                self._errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        rows = {}
+        for endpoint, samples in sorted(self._samples.items()):
+            rows[endpoint] = {
+                "count": len(samples),
+                "errors": self._errors[endpoint],
+                "error_rate": self._errors[endpoint] / len(samples),
+                "throughput": len(samples) / elapsed,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": max(samples) * 1000,
+            }
+        return rows
+
+
+class Student:
+    def __init__(self, base_url, recorder, name, class_code, timeout):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.name = name
+        self.class_code = class_code
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.etag = None
+
+    def call(self, endpoint, method, path, ok_statuses=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            ok = response.status_code in ok_statuses
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(endpoint, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def stream_chat(self, session_id, message):
+        # Records time to first token separately from the whole reply.
+        started = time.perf_counter()
+        first_token = None
+        ok = False
+        try:
+            with self.http.post(self.base_url + "/chat/stream", json={"session_id": session_id, "message": message},
+                                stream=True, timeout=self.timeout) as response:
+                if response.status_code == 200:
+                    # Tokens are unnamed events; the last one is "done" or "error".
+                    event = None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event: "):
+                            event = line[len("event: "):]
+                        elif line.startswith("data: "):
+                            if event is None and first_token is None:
+                                first_token = time.perf_counter() - started
+                            elif event == "done":
+                                ok = True
+                            elif event == "error":
+                                break
+                        elif not line:
+                            event = None
+        except requests.RequestException:
+            pass
+        self.recorder.record("POST /chat/stream", time.perf_counter() - started, ok)
+        if first_token is not None:
+            self.recorder.record("POST /chat/stream (first token)", first_token, True)
+
+    def run(self, cases, turns, diagnoses, stream, think_seconds):
+        credentials = {"username": self.name, "password": "loadtest-password"}
+        self.call("POST /auth/register", "POST", "/auth/register", (201,),
+                  json=dict(credentials, class_code=self.class_code))
+        login = self.call("POST /auth/login", "POST", "/auth/login", json=credentials)
+        if login is None:
+            return
+        self.http.headers["Authorization"] = f"Bearer {login.json()['token']}"
+
+        for _ in range(cases):
+            started = self.call("POST /chat/start/random", "POST", "/chat/start/random", json={})
+            if started is None:
+                continue
+            session_id = started.json()["session_id"]
+            for _ in range(turns):
+                message = random.choice(QUESTIONS)
+                if stream:
+                    self.stream_chat(session_id, message)
+                else:
+                    self.call("POST /chat", "POST", "/chat", json={"session_id": session_id, "message": message})
+                time.sleep(think_seconds)
+            self.call("POST /chat/diagnose", "POST", "/chat/diagnose",
+                      json={"session_id": session_id, "diagnosis": random.choice(diagnoses)})
+            self.poll()
+
+    def poll(self):
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        profile = self.call("GET /auth/profile", "GET", "/auth/profile", (200, 304), headers=headers)
+        if profile is not None and profile.headers.get("ETag"):
+            self.etag = profile.headers["ETag"]
+        self.call("GET /auth/leaderboard", "GET", "/auth/leaderboard?limit=20")
+        self.call("GET /auth/leaderboard (class)", "GET", "/auth/leaderboard?scope=classroom&period=weekly")
+
+
+def prepare_app(classrooms):
+    # Runs in a backend subprocess: initializes the throwaway database and
+    # adds the load-test classrooms.
+    from app import create_app, db, Classroom
+
+    app = create_app()
+    with app.app_context():
+        for index in range(classrooms):
+            db.session.add(Classroom(name=f"Load test {index + 1}", join_code=f"LOAD{index + 1}"))
+        db.session.commit()
+    return app
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, workdir):
+    quiet = None if args.verbose else subprocess.DEVNULL
+    mock = subprocess.Popen([
+        sys.executable, "mock_llm.py", "--port", str(args.mock_port),
+        "--base-latency-ms", str(args.base_latency_ms), "--per-item-ms", str(args.per_item_ms),
+        "--per-token-ms", str(args.per_token_ms), "--distribution", args.distribution,
+        "--jitter-ms", str(args.jitter_ms), "--concurrency", str(args.gpu_concurrency),
+        "--error-rate", str(args.error_rate),
+    ], cwd=BACKEND_DIR, stdout=quiet, stderr=quiet)
+
+    env = dict(os.environ)
+    env["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "loadtest.db")
+    env["COLAB_URL"] = f"http://127.0.0.1:{args.mock_port}"
+    if args.server == "prod":
+        # serve.py with its own worker settings (WEB_CONCURRENCY, WEB_THREADS).
+        subprocess.run([sys.executable, "-m", "benchmarks.loadtest", "--prepare-app", "--classrooms", str(args.classrooms)],
+                       cwd=BACKEND_DIR, env=env, stdout=quiet, stderr=quiet, check=True)
+        env.update(HOST="127.0.0.1", PORT=str(args.port))
+        backend = subprocess.Popen([sys.executable, "serve.py"], cwd=BACKEND_DIR, env=env, stdout=quiet, stderr=quiet)
+    else:
+        backend = subprocess.Popen([
+            sys.executable, "-m", "benchmarks.loadtest", "--serve-app",
+            "--port", str(args.port), "--classrooms", str(args.classrooms),
+        ], cwd=BACKEND_DIR, env=env, stdout=quiet, stderr=quiet)
+
+    try:
+        wait_until_up(f"http://127.0.0.1:{args.mock_port}/health", mock)
+        wait_until_up(f"http://127.0.0.1:{args.port}/auth/leaderboard", backend)
+    except Exception:
+        stop_servers(mock, backend)
+        raise
+    return mock, backend
+
+
+def stop_servers(*processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_report(rows, elapsed, students):
+    print(f"\n{students} students in {elapsed:.1f} s\n")
+    print(f"{'endpoint':<34} {'count':>6} {'err %':>6} {'req/s':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for endpoint, row in rows.items():
+        print(f"{endpoint:<34} {row['count']:>6} {row['error_rate'] * 100:>6.1f} {row['throughput']:>7.1f} "
+              f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
+
+
+def main(args):
+    from disease_registry import load_catalog_file
+
+    _, catalog = load_catalog_file(os.path.join(BACKEND_DIR, "diseases.json"))
+    diagnoses = [entry["name"] for entry in catalog]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.base_url:
+            servers = ()
+            base_url = args.base_url.rstrip("/")
+        else:
+            servers = start_servers(args, workdir)
+            base_url = f"http://127.0.0.1:{args.port}"
+
+        recorder = Recorder()
+        run_id = int(time.time())
+        students = [
+            Student(base_url, recorder, f"load{run_id}_{index}",
+                    f"LOAD{index % args.classrooms + 1}" if args.classrooms else "", args.timeout)
+            for index in range(args.students)
+        ]
+        threads = []
+        started = time.perf_counter()
+        try:
+            for student in students:
+                thread = threading.Thread(target=student.run, daemon=True, args=(
+                    args.cases, args.turns, diagnoses, args.stream, args.think_ms / 1000.0))
+                thread.start()
+                threads.append(thread)
+                time.sleep(args.ramp_seconds / max(1, args.students))
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            stop_servers(*servers)
+
+    rows = recorder.summary(elapsed)
+    print_report(rows, elapsed, args.students)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "elapsed_seconds": elapsed, "endpoints": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load test against a stub generator")
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--classrooms", type=int, default=2)
+    parser.add_argument("--cases", type=int, default=2, help="cases per student")
+    parser.add_argument("--turns", type=int, default=4, help="chat turns per case")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between chat turns")
+    parser.add_argument("--ramp-seconds", type=float, default=2, help="spread student start times over this long")
+    parser.add_argument("--stream", action="store_true", help="chat through /chat/stream")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=9203)
+    parser.add_argument("--mock-port", type=int, default=9201)
+    parser.add_argument("--base-url", help="load an already running backend instead of starting one")
+    parser.add_argument("--server", choices=["dev", "prod"], default="dev",
+                        help="threaded development server, or serve.py")
+    parser.add_argument("--base-latency-ms", type=float, default=200)
+    parser.add_argument("--per-item-ms", type=float, default=20)
+    parser.add_argument("--per-token-ms", type=float, default=0)
+    parser.add_argument("--distribution", choices=["constant", "uniform", "normal", "lognormal"], default="lognormal")
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--gpu-concurrency", type=int, default=4)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show server output")
+    parser.add_argument("--serve-app", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--prepare-app", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare_app:
+        prepare_app(args.classrooms)
+    elif args.serve_app:
+        prepare_app(args.classrooms).run(host="127.0.0.1", port=args.port, threaded=True, use_reloader=False)
+    else:
+        main(args)
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from benchmarks.bench_batching import percentile
+
+# Offline replay of recorded sessions: every student question of the stored
+# transcripts is sent again to a patient model, with the prompt built by the
+# same ContextBuilder and window as /chat, and the new reply is compared
+# with the reply stored at the time. Use it to check a changed system prompt
+# or a new model against real conversations before students see it.
+#
+# Each question is replayed on the stored conversation up to that point
+# (not on earlier replayed replies), so every turn is compared like for like.
+# Sessions run in parallel (--parallel), each one's turns in order. Results
+# go to a JSON-lines checkpoint, one line per finished session; rerunning
+# with the same --checkpoint skips sessions already replayed without errors.
+#
+# Run from DentalSimBackend/ with the backend's environment (DATABASE_URL,
+# LLM_ENDPOINTS, CONTEXT_* ...):
+#   python -m benchmarks.replay --disease-id 3 --limit 500 --parallel 16
+#   python -m benchmarks.replay --endpoint http://127.0.0.1:9100 --prompt 3=new_prompt.txt --diffs 5
+
+CHUNK_SESSIONS = 200
+
+
+def load_checkpoint(path):
+    # -> {session_id: record}, the last record of each session winning
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["session_id"]] = record
+    return records
+
+
+def iter_jobs(args, skip):
+    # Yields one job per recorded session, reading the database in chunks so
+    # thousands of sessions are never all in memory.
+    from app import app, db, ChatSession, ChatMessage, disease_registry
+
+    with app.app_context():
+        prompts = {disease.id: disease.system_prompt for disease in disease_registry.all()}
+        for disease_id, path in args.prompt:
+            with open(path) as f:
+                prompts[disease_id] = f.read()
+        window = app.config['CONTEXT_WINDOW_MESSAGES']
+
+        query = ChatSession.query.order_by(ChatSession.id)
+        if args.session_id:
+            query = query.filter(ChatSession.id.in_(args.session_id))
+        if args.disease_id:
+            query = query.filter(ChatSession.disease_id.in_(args.disease_id))
+        if args.completed_only:
+            query = query.filter(ChatSession.is_completed == True)
+        if args.since:
+            query = query.filter(ChatSession.start_time >= args.since)
+        if args.until:
+            query = query.filter(ChatSession.start_time < args.until)
+
+        last_id, yielded = 0, 0
+        while not args.limit or yielded < args.limit:
+            sessions = query.filter(ChatSession.id > last_id).limit(CHUNK_SESSIONS).all()
+            if not sessions:
+                return
+            last_id = sessions[-1].id
+            sessions = [s for s in sessions if s.id not in skip and s.disease_id in prompts]
+            transcripts = defaultdict(list)
+            for message in ChatMessage.query.filter(ChatMessage.session_id.in_([s.id for s in sessions])).order_by(
+                    ChatMessage.session_id, ChatMessage.timestamp, ChatMessage.id):
+                transcripts[message.session_id].append((message.sender, message.content))
+            db.session.remove()
+
+            for session in sessions:
+                turns = build_turns(transcripts[session.id], window)
+                if not turns:
+                    continue
+                yield {"session_id": session.id, "disease_id": session.disease_id,
+                       "system_prompt": prompts[session.disease_id], "turns": turns}
+                yielded += 1
+                if args.limit and yielded >= args.limit:
+                    return
+
+
+def build_turns(transcript, window):
+    # -> [(history, question, stored_reply)], history as /chat would hold it
+    turns = []
+    for index, (sender, content) in enumerate(transcript):
+        if sender != "student":
+            continue
+        history = [{"role": "user" if s == "student" else "assistant", "content": c} for s, c in transcript[:index]]
+        following = transcript[index + 1] if index + 1 < len(transcript) else None
+        stored = following[1] if following and following[0] != "student" else None
+        turns.append((history[-window:], content, stored))
+    return turns
+
+
+def replay_session(job, router, context_builder, args):
+    results = []
+    for number, (history, question, stored) in enumerate(job["turns"]):
+        payload = context_builder.build_payload(job["system_prompt"], history, question)
+        if args.temperature is not None:
+            payload["temperature"] = args.temperature
+        started = time.perf_counter()
+        reply, error = None, None
+        try:
+            response = router.post(payload, args.timeout)
+            if response.status_code == 200:
+                reply = response.json().get("generated_text", "")
+            else:
+                error = f"HTTP {response.status_code}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append({
+            "turn": number,
+            "question": question,
+            "stored": stored,
+            "reply": reply,
+            "error": error,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "similarity": similarity(stored, reply)
+        })
+    return {"session_id": job["session_id"], "disease_id": job["disease_id"], "turns": results}
+
+
+def similarity(stored, reply):
+    if stored is None or reply is None:
+        return None
+    return round(difflib.SequenceMatcher(None, stored.strip(), reply.strip()).ratio(), 4)
+
+
+def summarize(records, replayed_turns, elapsed):
+    turns = [turn for record in records for turn in record["turns"]]
+    answered = [turn for turn in turns if turn["error"] is None]
+    latencies = [turn["latency_ms"] for turn in answered]
+    scored = [turn["similarity"] for turn in answered if turn["similarity"] is not None]
+
+    by_disease = defaultdict(list)
+    for record in records:
+        by_disease[record["disease_id"]].extend(
+            turn["similarity"] for turn in record["turns"] if turn["error"] is None and turn["similarity"] is not None)
+
+    return {
+        "sessions": len(records),
+        "turns": len(turns),
+        "errors": len(turns) - len(answered),
+        "replayed_turns": replayed_turns,
+        "elapsed_seconds": elapsed,
+        "turns_per_second": replayed_turns / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) if latencies else None,
+        "p95_ms": percentile(latencies, 95) if latencies else None,
+        "p99_ms": percentile(latencies, 99) if latencies else None,
+        "mean_similarity": sum(scored) / len(scored) if scored else None,
+        "exact_match_rate": sum(1 for s in scored if s == 1.0) / len(scored) if scored else None,
+        "diseases": {
+            disease_id: {"turns": len(values), "mean_similarity": sum(values) / len(values) if values else None}
+            for disease_id, values in sorted(by_disease.items())
+        }
+    }
+
+
+def print_report(summary):
+    print(f"\n{summary['sessions']} sessions, {summary['turns']} turns ({summary['errors']} errors)")
+    print(f"This run: {summary['replayed_turns']} turns in {summary['elapsed_seconds']:.1f} s, "
+          f"{summary['turns_per_second']:.1f} turns/s")
+    if summary["p50_ms"] is not None:
+        print(f"Latency: p50 {summary['p50_ms']:.0f} ms   p95 {summary['p95_ms']:.0f} ms   p99 {summary['p99_ms']:.0f} ms")
+    if summary["mean_similarity"] is not None:
+        print(f"Similarity to stored replies: mean {summary['mean_similarity']:.3f}, "
+              f"exact {summary['exact_match_rate'] * 100:.1f} %\n")
+        print(f"{'disease':>8} {'turns':>7} {'similarity':>11}")
+        for disease_id, row in summary["diseases"].items():
+            if row["mean_similarity"] is not None:
+                print(f"{disease_id:>8} {row['turns']:>7} {row['mean_similarity']:>11.3f}")
+
+
+def print_diffs(records, count):
+    turns = [(turn["similarity"], record["session_id"], turn) for record in records for turn in record["turns"]
+             if turn["similarity"] is not None]
+    for score, session_id, turn in sorted(turns, key=lambda item: item[0])[:count]:
+        print(f"\n--- session {session_id}, turn {turn['turn']} (similarity {score:.3f})")
+        print(f"Q: {turn['question']}")
+        for line in difflib.unified_diff(turn["stored"].splitlines(), turn["reply"].splitlines(),
+                                         "stored", "replayed", lineterm=""):
+            print(line)
+
+
+def main(args):
+    # Read the catalog from the database only; a locally edited diseases.json
+    # must not be written into a shared database by an offline tool.
+    os.environ["DISEASE_CATALOG_WATCH"] = "0"
+    from app import app, context_builder
+    from model_router import ModelRouter
+
+    records = load_checkpoint(args.checkpoint)
+    skip = {session_id for session_id, record in records.items()
+            if all(turn["error"] is None for turn in record["turns"])}
+    if skip:
+        print(f"Resuming: {len(skip)} session(s) already replayed in {args.checkpoint}")
+
+    router = ModelRouter(args.endpoint or app.config['LLM_ENDPOINTS'], pool_maxsize=args.parallel,
+                         max_attempts=args.attempts, health_interval=0)
+    replayed_turns = 0
+    started = time.perf_counter()
+    with open(args.checkpoint, "a") as checkpoint, ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        pending = set()
+
+        def collect():
+            nonlocal pending, replayed_turns
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                records[record["session_id"]] = record
+                replayed_turns += len(record["turns"])
+                checkpoint.write(json.dumps(record) + "\n")
+                checkpoint.flush()
+            print(f"\r{len(records)} sessions, {replayed_turns} turns replayed", end="", file=sys.stderr)
+
+        try:
+            for job in iter_jobs(args, skip):
+                # Keeps the database reader at most a few sessions ahead.
+                if len(pending) >= args.parallel * 2:
+                    collect()
+                pending.add(pool.submit(replay_session, job, router, context_builder, args))
+            while pending:
+                collect()
+        except KeyboardInterrupt:
+            print(f"\nInterrupted; rerun with --checkpoint {args.checkpoint} to resume", file=sys.stderr)
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            router.close()
+    elapsed = time.perf_counter() - started
+
+    summary = summarize(list(records.values()), replayed_turns, elapsed)
+    print_report(summary)
+    if args.diffs:
+        print_diffs(list(records.values()), args.diffs)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "summary": summary}, f, indent=2, default=str)
+
+
+def prompt_override(value):
+    disease_id, _, path = value.partition("=")
+    if not disease_id.isdigit() or not path:
+        raise argparse.ArgumentTypeError("expected DISEASE_ID=PATH")
+    return int(disease_id), path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded sessions against a patient model")
+    parser.add_argument("--endpoint", action="append", help="generator base URL (repeatable); default LLM_ENDPOINTS")
+    parser.add_argument("--checkpoint", default="replay-results.jsonl", help="results file, also used to resume")
+    parser.add_argument("--parallel", type=int, default=8, help="sessions replayed at once")
+    parser.add_argument("--attempts", type=int, default=2, help="endpoints tried per turn")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per turn")
+    parser.add_argument("--temperature", type=float, help="override the configured temperature")
+    parser.add_argument("--prompt", type=prompt_override, action="append", default=[], metavar="DISEASE_ID=PATH",
+                        help="replay this disease with the system prompt in PATH (repeatable)")
+    parser.add_argument("--session-id", type=int, action="append")
+    parser.add_argument("--disease-id", type=int, action="append")
+    parser.add_argument("--completed-only", action="store_true")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="sessions started at or after")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, help="sessions started before")
+    parser.add_argument("--limit", type=int, default=0, help="at most this many sessions (0 = all)")
+    parser.add_argument("--diffs", type=int, default=0, help="show diffs for the N least similar turns")
+    parser.add_argument("--json", help="also write the summary to this file")
+    main(parser.parse_args())
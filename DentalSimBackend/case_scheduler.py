@@ -0,0 +1,92 @@
+import time
+import random
+import threading
+
+# --- CASE SCHEDULER ---
+# Picks the disease for a new case from an in-memory copy of the catalog.
+#
+# "uniform" picks any disease with equal probability. "adaptive" favours
+# what the student gets wrong: each category is weighted by
+# (1 - smoothed accuracy) times its number of diseases and a category is
+# drawn, then a disease within it, weighted the same way by the student's
+# accuracy on that disease. So mastered diseases come up less often even
+# when the whole catalog is one category. Diseases from the student's last
+# few cases are redrawn a couple of times so the same patient does not come
+# back immediately.
+
+
+class CaseScheduler:
+    def __init__(self, load_catalog, mode="adaptive", min_weight=0.15, recent_redraws=2, refresh_seconds=300):
+        # load_catalog() -> [(disease_id, name, category)]
+        self.load_catalog = load_catalog
+        self.mode = mode
+        self.min_weight = min_weight
+        self.recent_redraws = recent_redraws
+        self.refresh_seconds = refresh_seconds
+
+        # Catalog snapshot, replaced as a whole on refresh:
+        # (diseases, {category: diseases}, categories, category sizes,
+        #  {category: within-category weights for a student with no history})
+        self._catalog = ([], {}, [], [], {})
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+                return self._catalog
+            diseases = [tuple(row) for row in self.load_catalog()]
+            by_category = {}
+            for disease in diseases:
+                by_category.setdefault(disease[2] or "General", []).append(disease)
+            categories = list(by_category)
+            fresh = self._weight((0, 0))
+            self._catalog = (diseases, by_category, categories, [len(by_category[c]) for c in categories],
+                             {c: [fresh] * len(by_category[c]) for c in categories})
+            self._loaded_at = time.monotonic()
+            return self._catalog
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _weight(self, stats):
+        # stats: (cases_completed, cases_correct)
+        completed, correct = stats
+        mastery = (correct + 1) / (completed + 2)
+        return max(self.min_weight, 1 - mastery)
+
+    def pick(self, category_stats=None, recent_ids=(), mode=None, category=None, disease_stats=None):
+        # category_stats: {category: (cases_completed, cases_correct)}
+        # disease_stats: {disease_id: (cases_completed, cases_correct)}
+        diseases, by_category, categories, sizes, fresh_weights = self._ensure_loaded()
+        mode = mode or self.mode
+        candidates = by_category.get(category, []) if category is not None else diseases
+        if not candidates:
+            return None
+
+        if mode == "uniform":
+            draw = lambda: random.choice(candidates)
+        else:
+            # Only the drawn category's weights are built, and only for a
+            # student who has history.
+            within = {} if disease_stats else fresh_weights
+
+            def draw_within(name):
+                if name not in within:
+                    within[name] = [self._weight(disease_stats.get(d[0], (0, 0))) for d in by_category[name]]
+                return random.choices(by_category[name], weights=within[name])[0]
+
+            if category is not None:
+                draw = lambda: draw_within(category)
+            else:
+                category_stats = category_stats or {}
+                weight_list = [self._weight(category_stats.get(c, (0, 0))) * size for c, size in zip(categories, sizes)]
+                draw = lambda: draw_within(random.choices(categories, weights=weight_list)[0])
+
+        disease = draw()
+        for _ in range(self.recent_redraws):
+            if disease[0] not in recent_ids:
+                break
+            disease = draw()
+        return disease
@@ -0,0 +1,99 @@
+import hashlib
+
+# --- PROMPT / CONTEXT BUILDER ---
+# Turns a session's system prompt and rolling history into the /generate
+# payload. History is trimmed newest-first to fit a token budget, older turns
+# can be folded into a short summary, and the system prompt always comes
+# first and unchanged so the generator can reuse its KV cache for it; the
+# payload carries `prefix_id` (a hash of that prompt) for that purpose.
+
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; good enough for budgeting.
+    return max(1, (len(text) + 3) // 4)
+
+
+def load_estimator(name=None):
+    # "hf:<model name>" counts with that model's tokenizer when `transformers`
+    # is installed; anything else uses the character heuristic.
+    if name and name.startswith("hf:"):
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            print("transformers is not installed, using the approximate token estimator.")
+            return estimate_tokens
+        tokenizer = AutoTokenizer.from_pretrained(name[3:])
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    return estimate_tokens
+
+
+def prefix_id(system_prompt):
+    return hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def summarize_turns(messages):
+    # Extractive summary of dropped turns: the questions already asked, so the
+    # patient stays consistent without replaying the whole conversation.
+    questions = [m["content"].strip() for m in messages if m["role"] == "user" and m["content"].strip()]
+    if not questions:
+        return None
+    return "Earlier in this visit the dentist already asked: " + " | ".join(questions)
+
+
+class ContextBuilder:
+    def __init__(self, max_prompt_tokens=1536, max_new_tokens=150, temperature=0.2,
+                 estimator=estimate_tokens, summarize=False, summary_tokens=128):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.estimator = estimator
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+
+    def _cost(self, message):
+        return self.estimator(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def trim(self, system_prompt, history, user_message):
+        # Returns (kept_history, dropped_history). The system prompt and the new
+        # question are always sent, even if they alone exceed the budget.
+        budget = self.max_prompt_tokens
+        budget -= self._cost({"content": system_prompt}) + self._cost({"content": user_message})
+        if self.summarize:
+            budget -= self.summary_tokens
+
+        kept = []
+        for message in reversed(history):
+            cost = self._cost(message)
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append(message)
+        kept.reverse()
+        return kept, history[:len(history) - len(kept)]
+
+    def build_messages(self, system_prompt, history, user_message):
+        kept, dropped = self.trim(system_prompt, history, user_message)
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if self.summarize and dropped:
+            summary = summarize_turns(dropped)
+            if summary:
+                # Cut to the reserved summary budget, keeping the most recent questions.
+                max_chars = self.summary_tokens * 4
+                if len(summary) > max_chars:
+                    summary = "..." + summary[-max_chars:]
+                messages.append({"role": "system", "content": summary})
+        messages.extend(kept)
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def build_payload(self, system_prompt, history, user_message):
+        return {
+            "messages": self.build_messages(system_prompt, history, user_message),
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+            "prefix_id": prefix_id(system_prompt),
+            "cache_prompt": True
+        }
@@ -0,0 +1,111 @@
+import abc
+import time
+import threading
+from collections import OrderedDict
+
+# --- SESSION CONTEXT STORE ---
+# Keeps the rolling message window and system prompt of active chat sessions
+# so a /chat turn does not have to re-read them from the database. The DB
+# stays the source of truth: the store is filled from it on a miss and
+# appended to as turns are saved.
+#
+# `message_count` is the number of messages the session had when the
+# context was loaded plus those appended since. Comparing it with the
+# database tells whether a turn was saved by another process since, in
+# which case the cached window is stale.
+#
+# ContextStore is the abstract interface; InMemoryContextStore serves a
+# single process. A shared backend (e.g. Redis) subclasses it and must
+# implement all five methods.
+
+
+class SessionContext:
+    __slots__ = ("session_id", "user_id", "disease_id", "system_prompt", "messages", "window", "message_count")
+
+    def __init__(self, session_id, user_id, disease_id, system_prompt, messages=(), window=9, message_count=None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.disease_id = disease_id
+        self.system_prompt = system_prompt
+        self.window = window
+        # Replaced, never mutated, so readers can use it without locking.
+        self.messages = tuple(messages)[-window:]
+        self.message_count = message_count
+
+    def append(self, role, content):
+        self.messages = (self.messages + ({"role": role, "content": content},))[-self.window:]
+        if self.message_count is not None:
+            self.message_count += 1
+
+    def history(self):
+        return list(self.messages)
+
+
+class ContextStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, session_id):
+        ...
+
+    @abc.abstractmethod
+    def put(self, context):
+        ...
+
+    @abc.abstractmethod
+    def append(self, session_id, role, content):
+        ...
+
+    @abc.abstractmethod
+    def evict(self, session_id):
+        ...
+
+    @abc.abstractmethod
+    def evict_disease(self, disease_id):
+        ...
+
+
+class InMemoryContextStore(ContextStore):
+    def __init__(self, max_sessions=5000, idle_ttl=3600):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[session_id]
+                self.misses += 1
+                return None
+            self._entries[session_id] = (entry[0], time.monotonic() + self.idle_ttl)
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, context):
+        with self._lock:
+            self._entries[context.session_id] = (context, time.monotonic() + self.idle_ttl)
+            self._entries.move_to_end(context.session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def append(self, session_id, role, content):
+        # Sessions that were evicted in the meantime are simply reloaded from
+        # the DB on their next turn.
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry[0].append(role, content)
+
+    def evict(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def evict_disease(self, disease_id):
+        with self._lock:
+            for session_id in [k for k, (ctx, _) in self._entries.items() if ctx.disease_id == disease_id]:
+                del self._entries[session_id]
@@ -0,0 +1,122 @@
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# --- CREDENTIALS ---
+# Password hashing is deliberately slow and holds the GIL, so a burst of
+# logins at the start of a class would stall every other request of the
+# process. PasswordHasher runs it on a small process pool instead, with a
+# bound on how many hashes may be waiting; beyond that callers get
+# CredentialsBusy and the client is asked to retry.
+#
+# `method` is any werkzeug method string ("scrypt", "pbkdf2:sha256:600000").
+# Hashes made with other parameters still verify, and verify() reports them
+# so they can be rehashed on the next successful login.
+
+
+class CredentialsBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many logins at once, try again shortly")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    def __init__(self, method="scrypt", workers=2, max_pending=64, retry_after=2):
+        self.method = method
+        self.workers = workers
+        self.retry_after = retry_after
+        # e.g. "scrypt:32768:8:1" - the part of a hash before the salt.
+        self.prefix = generate_password_hash("", method).split("$", 1)[0]
+
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        if not self._pending.acquire(blocking=False):
+            raise CredentialsBusy(self.retry_after)
+        try:
+            if not self.workers:
+                return fn(*args)
+            try:
+                return self._executor().submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A pool process died; start a fresh pool next time and
+                # answer this caller inline rather than failing the login.
+                self.close()
+                return fn(*args)
+        finally:
+            self._pending.release()
+
+    def _executor(self):
+        # Created on first use, so each server worker gets its own pool after
+        # forking; "spawn" keeps the pool processes free of the parent's threads.
+        # Spawned processes import the launching script (as __mp_main__), so
+        # it must keep its setup under a __main__ guard, like serve.py does.
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        # -> (matches, needs_rehash)
+        matches = self._run(check_password_hash, password_hash, password)
+        return matches, matches and password_hash.split("$", 1)[0] != self.prefix
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
+class RateLimiter:
+    # Sliding window: at most `max_hits` per key within `window` seconds.
+    def __init__(self, max_hits, window):
+        self.max_hits = max_hits
+        self.window = window
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key)
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        return hits
+
+    def retry_after(self, key):
+        # Seconds until `key` may try again; 0 if it may now.
+        if not self.max_hits:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            hits = self._recent(key, now)
+            if not hits or len(hits) < self.max_hits:
+                return 0
+            return max(1, int(hits[0] + self.window - now + 1))
+
+    def hit(self, key):
+        if not self.max_hits:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._hits.setdefault(key, deque()).append(now)
+            if now - self._last_sweep > self.window:
+                self._sweep(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for key in [key for key, hits in self._hits.items() if not hits or hits[-1] <= now - self.window]:
+            del self._hits[key]
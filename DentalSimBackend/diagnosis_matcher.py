@@ -0,0 +1,148 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+# --- DIAGNOSIS MATCHING ---
+# Maps a free-text diagnosis to a disease in the catalog. Canonical names,
+# synonyms and abbreviations are normalized into phrases once, when the
+# index is built. A lookup then tries, in order:
+#   1. the whole answer is a known phrase                    (confidence 1.0)
+#   2. a known phrase appears as whole words in the answer;  (0.95, or 0.6
+#      the longest one wins                                   if ambiguous)
+#   3. typo-tolerant match: phrases sharing character trigrams with the
+#      answer are compared by edit distance                  (similarity)
+# Matching whole words keeps "irreversible pulpitis" from also matching
+# "reversible pulpitis".
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+EXACT_CONFIDENCE = 1.0
+CONTAINED_CONFIDENCE = 0.95
+AMBIGUOUS_CONFIDENCE = 0.6
+FUZZY_CANDIDATES = 8
+FUZZY_MIN_SCORE = 0.5
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b, min_score=0.0):
+    # 1 - normalized Levenshtein distance. Returns 0.0 as soon as the score
+    # is known to fall below `min_score`, which skips most comparisons.
+    if a == b:
+        return 1.0
+    longest = max(len(a), len(b))
+    if not a or not b:
+        return 0.0
+    max_distance = int((1.0 - min_score) * longest)
+    if abs(len(a) - len(b)) > max_distance:
+        return 0.0
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return 0.0
+        previous = current
+    return 1.0 - previous[-1] / longest
+
+
+class DiagnosisMatch:
+    __slots__ = ("disease_id", "name", "confidence", "matched")
+
+    def __init__(self, disease_id, name, confidence, matched):
+        self.disease_id = disease_id
+        self.name = name
+        self.confidence = confidence
+        self.matched = matched
+
+
+class DiagnosisMatcher:
+    def __init__(self, diseases):
+        # diseases: [(disease_id, canonical_name, [synonyms and abbreviations])]
+        self.names = {}
+        self.phrases = {}
+        self.max_phrase_words = 1
+        self._trigram_index = defaultdict(set)
+
+        for disease_id, name, aliases in diseases:
+            self.names[disease_id] = name
+            for alias in [name] + list(aliases or []):
+                phrase = normalize(alias)
+                if not phrase:
+                    continue
+                # A phrase shared by two diseases would be ambiguous; first wins.
+                self.phrases.setdefault(phrase, disease_id)
+
+        for phrase in self.phrases:
+            self.max_phrase_words = max(self.max_phrase_words, len(phrase.split()))
+            for gram in trigrams(phrase):
+                self._trigram_index[gram].add(phrase)
+
+    def _result(self, phrase, confidence):
+        disease_id = self.phrases[phrase]
+        return DiagnosisMatch(disease_id, self.names[disease_id], confidence, phrase)
+
+    def match(self, text):
+        answer = normalize(text)
+        if not answer:
+            return None
+
+        if answer in self.phrases:
+            return self._result(answer, EXACT_CONFIDENCE)
+
+        words = answer.split()
+        contained = self._longest_contained(words)
+        if contained:
+            return contained
+
+        return self._fuzzy(answer, words)
+
+    def _longest_contained(self, words):
+        for length in range(min(self.max_phrase_words, len(words)), 0, -1):
+            found = {}
+            for start in range(len(words) - length + 1):
+                phrase = " ".join(words[start:start + length])
+                if phrase in self.phrases:
+                    found.setdefault(self.phrases[phrase], phrase)
+            if len(found) == 1:
+                return self._result(next(iter(found.values())), CONTAINED_CONFIDENCE)
+            if found:
+                # e.g. "pulp necrosis or periodontal abscess": report the first, flagged.
+                return self._result(next(iter(found.values())), AMBIGUOUS_CONFIDENCE)
+        return None
+
+    def _fuzzy(self, answer, words):
+        # Candidate phrases are the ones sharing the most trigrams with the
+        # answer, so the edit-distance work stays constant as the catalog grows.
+        overlap = defaultdict(int)
+        for gram in trigrams(answer):
+            for phrase in self._trigram_index.get(gram, ()):
+                overlap[phrase] += 1
+        candidates = sorted(overlap, key=overlap.get, reverse=True)[:FUZZY_CANDIDATES]
+
+        best_phrase, best_score = None, FUZZY_MIN_SCORE
+        for phrase in candidates:
+            size = len(phrase.split())
+            # Compare against windows of the answer about the phrase's length,
+            # so a typo inside a longer sentence still matches.
+            windows = {answer}
+            for length in (size - 1, size, size + 1):
+                if 0 < length <= len(words):
+                    windows.update(" ".join(words[i:i + length]) for i in range(len(words) - length + 1))
+            for window in windows:
+                score = similarity(phrase, window, best_score)
+                if score > best_score:
+                    best_phrase, best_score = phrase, score
+
+        if best_phrase is None:
+            return None
+        return self._result(best_phrase, round(best_score, 3))
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+
+# --- DISEASE REGISTRY ---
+# Read-mostly copy of the disease catalog (names, categories, system
+# prompts) shared by all requests of a process, so chat turns and diagnoses
+# never fetch prompts from the database.
+#
+# Every `check_seconds` the registry compares a cheap DB stamp (row count,
+# latest update) and, when a catalog file is watched, the file's mtime. A
+# changed file is handed to `sync_catalog`, whose writes show up in the
+# stamp. On a stamp change it reloads and calls the `on_change(disease_id)` listeners for every
+# disease whose prompt version moved, so caches derived from a prompt can be
+# dropped. Edits made through another worker are picked up the same way.
+
+
+def load_catalog_file(path):
+    # Catalog file format: {"version": n, "diseases": [{"name", "category",
+    # "synonyms", "prompt"}]}; "prompt" may be a string or a list of lines.
+    with open(path, encoding="utf-8") as f:
+        catalog = json.load(f)
+    diseases = []
+    for entry in catalog.get("diseases", []):
+        prompt = entry["prompt"]
+        if isinstance(prompt, list):
+            prompt = "\n".join(prompt)
+        diseases.append({
+            "name": entry["name"],
+            "category": entry.get("category", "General"),
+            "synonyms": entry.get("synonyms", []),
+            "prompt": prompt
+        })
+    return catalog.get("version"), diseases
+
+
+class DiseaseEntry:
+    __slots__ = ("id", "name", "category", "system_prompt", "prompt_version", "synonyms")
+
+    def __init__(self, id, name, category, system_prompt, prompt_version, synonyms=None):
+        self.id = id
+        self.name = name
+        self.category = category or "General"
+        self.system_prompt = system_prompt
+        self.prompt_version = prompt_version or 1
+        # Stored as a JSON list in the disease table.
+        self.synonyms = json.loads(synonyms) if synonyms else []
+
+
+class DiseaseRegistry:
+    def __init__(self, load_entries, load_stamp, check_seconds=30, catalog_path=None, sync_catalog=None):
+        # load_entries() -> [(id, name, category, system_prompt, prompt_version, synonyms)]
+        # load_stamp() -> any value that changes whenever the disease table does
+        # sync_catalog(path) -> starts writing the catalog file into the
+        # database (a no-op for a file it has synced before). Called from a
+        # request, so it must not use that request's session; it calls
+        # invalidate() when done.
+        self.load_entries = load_entries
+        self.load_stamp = load_stamp
+        self.check_seconds = check_seconds
+        self.catalog_path = catalog_path
+        self.sync_catalog = sync_catalog
+
+        self._entries = {}
+        # Bumped on every reload, so indexes built from the catalog know to rebuild.
+        self.generation = 0
+        self._stamp = None
+        self._file_mtime = None
+        self._checked_at = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def on_change(self, listener):
+        self._listeners.append(listener)
+
+    def _file_changed(self):
+        if not self.catalog_path or not self.sync_catalog:
+            return False
+        try:
+            mtime = os.path.getmtime(self.catalog_path)
+        except OSError:
+            return False
+        if mtime == self._file_mtime:
+            return False
+        self._file_mtime = mtime
+        return True
+
+    def _ensure_fresh(self):
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_seconds:
+                return
+            self._checked_at = time.monotonic()
+
+            if self._file_changed():
+                self.sync_catalog(self.catalog_path)
+
+            stamp = self.load_stamp()
+            if stamp == self._stamp and self._entries:
+                return
+            self._stamp = stamp
+            changed = self._reload()
+
+        for disease_id in changed:
+            for listener in self._listeners:
+                listener(disease_id)
+
+    def _reload(self):
+        old = self._entries
+        entries = {row[0]: DiseaseEntry(*row) for row in self.load_entries()}
+        self._entries = entries
+        self.generation += 1
+        if not old:
+            return []
+        return [disease_id for disease_id, entry in entries.items()
+                if disease_id not in old or old[disease_id].prompt_version != entry.prompt_version]
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = None
+
+    def get(self, disease_id):
+        self._ensure_fresh()
+        entry = self._entries.get(disease_id)
+        if entry is None:
+            # Added since the last check (e.g. through another worker).
+            self.invalidate()
+            self._ensure_fresh()
+            entry = self._entries.get(disease_id)
+        return entry
+
+    def all(self):
+        self._ensure_fresh()
+        return list(self._entries.values())
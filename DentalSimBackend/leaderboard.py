@@ -0,0 +1,137 @@
+import time
+import bisect
+import datetime
+import threading
+
+# --- LEADERBOARD ---
+# Ordered rank structures kept in memory and updated as XP changes, so the
+# leaderboard and profile rank are served without sorting or counting the
+# user table. There is one board for all-time XP and one for the current
+# week's XP, each with per-classroom sub-boards.
+#
+# Every process keeps its own copy. It is rebuilt from the DB every
+# `refresh_seconds` (and when the week rolls over), which also picks up XP
+# earned through other workers.
+
+
+def week_start(now=None):
+    today = (now or datetime.datetime.utcnow()).date()
+    monday = today - datetime.timedelta(days=today.weekday())
+    return datetime.datetime.combine(monday, datetime.time())
+
+
+class RankIndex:
+    # Sorted list of (-xp, user_id): lookups are binary searches, updates move
+    # one entry.
+
+    def __init__(self):
+        self._keys = []
+        self._xp = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, user_id):
+        return user_id in self._xp
+
+    def set(self, user_id, xp):
+        old = self._xp.get(user_id)
+        if old == xp:
+            return
+        if old is not None:
+            index = bisect.bisect_left(self._keys, (-old, user_id))
+            del self._keys[index]
+        bisect.insort(self._keys, (-xp, user_id))
+        self._xp[user_id] = xp
+
+    def add(self, user_id, amount):
+        self.set(user_id, self._xp.get(user_id, 0) + amount)
+
+    def xp(self, user_id):
+        return self._xp.get(user_id, 0)
+
+    def rank(self, user_id):
+        # 1 + number of users with strictly more XP.
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        return bisect.bisect_left(self._keys, (-xp, float("-inf"))) + 1
+
+    def top(self, limit):
+        return [(user_id, -neg_xp) for neg_xp, user_id in self._keys[:limit]]
+
+
+class Board:
+    def __init__(self):
+        self.overall = RankIndex()
+        self.classrooms = {}
+
+    def classroom(self, classroom_id):
+        return self.classrooms.setdefault(classroom_id, RankIndex())
+
+    def set(self, user_id, classroom_id, xp):
+        self.overall.set(user_id, xp)
+        if classroom_id is not None:
+            self.classroom(classroom_id).set(user_id, xp)
+
+    def add(self, user_id, classroom_id, amount):
+        self.overall.add(user_id, amount)
+        if classroom_id is not None:
+            self.classroom(classroom_id).add(user_id, amount)
+
+    def index(self, classroom_id=None):
+        if classroom_id is None:
+            return self.overall
+        return self.classrooms.get(classroom_id, RankIndex())
+
+
+class Leaderboard:
+    def __init__(self, load_users, load_weekly, refresh_seconds=60):
+        # load_users() -> [(user_id, classroom_id, xp)]
+        # load_weekly(since) -> [(user_id, classroom_id, xp gained since `since`)]
+        self.load_users = load_users
+        self.load_weekly = load_weekly
+        self.refresh_seconds = refresh_seconds
+
+        self.all_time = Board()
+        self.weekly = Board()
+        self._week = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _ensure_fresh(self):
+        current_week = week_start()
+        stale = self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds
+        if not stale and current_week == self._week:
+            return
+
+        all_time, weekly = Board(), Board()
+        for user_id, classroom_id, xp in self.load_users():
+            all_time.set(user_id, classroom_id, xp or 0)
+        for user_id, classroom_id, xp in self.load_weekly(current_week):
+            weekly.set(user_id, classroom_id, xp or 0)
+
+        self.all_time, self.weekly = all_time, weekly
+        self._week = current_week
+        self._loaded_at = time.monotonic()
+
+    def _board(self, period):
+        return self.weekly if period == "weekly" else self.all_time
+
+    def record_xp(self, user_id, classroom_id, total_xp, gained):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self.all_time.set(user_id, classroom_id, total_xp)
+            if gained:
+                self.weekly.add(user_id, classroom_id, gained)
+
+    def top(self, limit=50, period="all", classroom_id=None):
+        with self._lock:
+            self._ensure_fresh()
+            return self._board(period).index(classroom_id).top(limit)
+
+    def rank(self, user_id, period="all", classroom_id=None):
+        with self._lock:
+            self._ensure_fresh()
+            return self._board(period).index(classroom_id).rank(user_id)
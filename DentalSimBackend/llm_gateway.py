@@ -0,0 +1,252 @@
+import json
+import time
+import threading
+import requests
+from concurrent.futures import TimeoutError as FutureTimeout
+from batching import MicroBatcher
+
+# --- LLM GATEWAY ---
+# Every call to the patient model goes through here. Requests share one
+# keep-alive connection pool, at most `max_in_flight` generations run at once,
+# up to `max_queue` more may wait for a slot, and anything beyond that is
+# rejected straight away so Flask workers are never parked on the model.
+#
+# Which replica answers, and retrying or hedging across replicas, is left
+# to the ModelRouter (model_router.py); the gateway only limits how many
+# replies are in progress. The deadline covers every attempt.
+#
+# `on_timing(name, seconds)`, when given, is called with "queue_wait" (time
+# spent waiting for an in-flight slot), "first_token" (streamed replies
+# only) and "generation" (slot acquired to reply complete).
+
+
+class GatewayError(Exception):
+    pass
+
+
+class GatewayBusy(GatewayError):
+    def __init__(self, retry_after):
+        super().__init__("Patient model is busy, try again shortly")
+        self.retry_after = retry_after
+
+
+class GatewayTimeout(GatewayError):
+    def __init__(self):
+        super().__init__("Patient model did not answer in time")
+
+
+class GatewayUnavailable(GatewayError):
+    def __init__(self, retry_after):
+        super().__init__("Patient model is unavailable, try again shortly")
+        self.retry_after = retry_after
+
+
+class LLMError(GatewayError):
+    def __init__(self, status_code):
+        super().__init__(f"LLM Error: {status_code}")
+        self.status_code = status_code
+
+
+class Reservation:
+    # A place in the gateway queue. Obtained from LLMGateway.reserve() before
+    # any work is done for the request, so a busy gateway can be reported
+    # without side effects. Released exactly once, on exit or stream end.
+
+    def __init__(self, gateway, timeout):
+        self.gateway = gateway
+        self.deadline = time.monotonic() + timeout
+        self._released = False
+        self._running = False
+        self._started_at = None
+        gateway._count("waiting", 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def _start(self):
+        # Waits in the queue for an in-flight slot, bounded by the deadline.
+        queued_at = time.monotonic()
+        if not self.gateway._in_flight.acquire(timeout=max(0, self.remaining())):
+            raise GatewayTimeout()
+        self._running = True
+        self._started_at = time.monotonic()
+        self.gateway._count("waiting", -1)
+        self.gateway._count("running", 1)
+        self.gateway._timing("queue_wait", self._started_at - queued_at)
+
+    def _finished(self):
+        self.gateway._timing("generation", time.monotonic() - self._started_at)
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._running:
+            self.gateway._in_flight.release()
+            self.gateway._count("running", -1)
+        else:
+            self.gateway._count("waiting", -1)
+        self.gateway._admitted.release()
+
+    def generate(self, payload):
+        if self.gateway.batcher:
+            return self._generate_batched(payload)
+
+        try:
+            self._start()
+            response = self.gateway.router.post(payload, self.remaining())
+        except requests.Timeout:
+            raise GatewayTimeout()
+        except requests.ConnectionError:
+            raise GatewayUnavailable(self.gateway.retry_after)
+        finally:
+            self.release()
+
+        if response.status_code != 200:
+            raise LLMError(response.status_code)
+        self._finished()
+        return response.json().get("generated_text", "")
+
+    def _generate_batched(self, payload):
+        try:
+            self._start()
+            future = self.gateway.batcher.submit(payload)
+            try:
+                reply = future.result(timeout=max(0, self.remaining()))
+                self._finished()
+                return reply
+            except FutureTimeout:
+                future.cancel()
+                raise GatewayTimeout()
+        finally:
+            self.release()
+
+    def stream(self, payload):
+        # Asks the generator to stream. Servers that ignore "stream" answer with
+        # the usual JSON body, which is relayed as a single chunk.
+        try:
+            self._start()
+            try:
+                with self.gateway.router.stream({**payload, "stream": True}, self.remaining()) as response:
+                    yield from self._relay(response)
+            except requests.Timeout:
+                raise GatewayTimeout()
+            except requests.ConnectionError:
+                raise GatewayUnavailable(self.gateway.retry_after)
+        finally:
+            self.release()
+
+    def _relay(self, response):
+        try:
+            if response.status_code != 200:
+                raise LLMError(response.status_code)
+
+            if response.headers.get("Content-Type", "").startswith("application/json"):
+                reply = response.json().get("generated_text", "")
+                self._finished()
+                yield reply
+                return
+
+            first = True
+            for token in _iter_stream_tokens(response):
+                if self.remaining() <= 0:
+                    raise GatewayTimeout()
+                if first and token:
+                    first = False
+                    self.gateway._timing("first_token", time.monotonic() - self._started_at)
+                yield token
+            self._finished()
+        finally:
+            response.close()
+
+
+def _iter_stream_tokens(response):
+    # Accepts SSE ("data: {...}"), JSON lines ({"token": "..."}) or raw text lines.
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        if line.startswith("data:"):
+            line = line[5:].strip()
+        if line == "[DONE]":
+            break
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            yield line
+            continue
+        if isinstance(chunk, dict):
+            yield chunk.get("token") or chunk.get("text") or chunk.get("generated_text") or ""
+        else:
+            yield str(chunk)
+
+
+class LLMGateway:
+    def __init__(self, router, max_in_flight=8, max_queue=32, timeout=120, retry_after=5,
+                 batch_url=None, batch_window_ms=0, batch_max_size=8, on_timing=None):
+        self.router = router
+        self.batch_url = batch_url
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.on_timing = on_timing
+
+        # Reservations waiting for a slot / generating right now.
+        self.waiting = 0
+        self.running = 0
+        self.draining = False
+        self._count_lock = threading.Lock()
+
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._admitted = threading.BoundedSemaphore(max_in_flight + max_queue)
+
+        # Streaming replies always go straight to the generator; batching only
+        # applies to whole-reply generate calls.
+        self.batcher = None
+        if batch_url and batch_window_ms > 0:
+            self.batcher = MicroBatcher(self._send_batch, window_ms=batch_window_ms, max_batch_size=batch_max_size)
+
+    def _count(self, field, delta):
+        with self._count_lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def _timing(self, name, seconds):
+        if self.on_timing:
+            self.on_timing(name, seconds)
+
+    def reserve(self, timeout=None):
+        if self.draining or not self._admitted.acquire(blocking=False):
+            raise GatewayBusy(self.retry_after)
+        return Reservation(self, timeout or self.timeout)
+
+    def _send_batch(self, payloads):
+        # Batched generator contract: {"requests": [payload, ...]} in,
+        # {"generated_texts": [reply, ...]} out, in the same order.
+        try:
+            response = self.router.session.post(self.batch_url, json={"requests": payloads}, headers=self.router.headers, timeout=self.timeout)
+        except requests.Timeout:
+            raise GatewayTimeout()
+        except requests.ConnectionError:
+            raise GatewayUnavailable(self.retry_after)
+        if response.status_code != 200:
+            raise LLMError(response.status_code)
+        return response.json().get("generated_texts", [])
+
+    def drain(self, timeout=30):
+        # Stops admitting requests and waits for the admitted ones to finish.
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while (self.waiting or self.running) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not (self.waiting or self.running)
+
+    def close(self):
+        if self.batcher:
+            self.batcher.close()
+        self.router.close()
@@ -0,0 +1,136 @@
+import math
+import threading
+
+# --- METRICS ---
+# Minimal in-process metrics rendered in the Prometheus text format, so the
+# backend can be scraped without extra dependencies. Counters and histograms
+# are updated on the request path; callback metrics read values that other
+# components already keep (cache hit counters, gateway load) at scrape time.
+# Each process keeps its own registry: with several workers, scrape every
+# worker or aggregate by instance.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + "_bucket", key, (("le", _format_value(bound)),), cumulative))
+            samples.append((self.name + "_sum", key, (), total))
+            samples.append((self.name + "_count", key, (), count))
+        return samples
+
+
+class CallbackMetric(Metric):
+    # Value read at scrape time: read() returns a number, or a dict mapping
+    # label value tuples to numbers.
+    def __init__(self, name, help, type, read, labels=()):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, tuple(str(v) for v in key), (), val) for key, val in sorted(value.items())]
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self.prefix + name, help, labels, buckets))
+
+    def callback(self, name, help, type, read, labels=()):
+        return self._register(CallbackMetric(self.prefix + name, help, type, read, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
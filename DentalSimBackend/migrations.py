@@ -0,0 +1,145 @@
+import datetime
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, inspect, select, text
+from analytics import aggregate
+
+# --- SCHEMA MIGRATIONS ---
+# db.create_all() creates missing tables but never touches existing ones, so
+# changes to tables that already exist in deployed databases (indexes,
+# constraints, new columns) are applied here, in order, once per database.
+# Applied versions are recorded in the schema_version table.
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200)),
+    Column("applied_at", DateTime)
+)
+
+
+def _create_indexes(conn, metadata):
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _add_hot_path_indexes(conn, metadata):
+    # Duplicate badges could be awarded by concurrent requests before the
+    # unique index existed; keep the earliest of each.
+    conn.execute(text(
+        "DELETE FROM user_badge WHERE id NOT IN "
+        "(SELECT MIN(id) FROM user_badge GROUP BY user_id, badge_name)"
+    ))
+    _create_indexes(conn, metadata)
+
+
+def _add_columns(conn, table, columns):
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def _add_disease_prompt_versions(conn, metadata):
+    _add_columns(conn, "disease", [("prompt_version", "INTEGER DEFAULT 1"), ("updated_at", "TIMESTAMP")])
+    conn.execute(text("UPDATE disease SET prompt_version = 1 WHERE prompt_version IS NULL"))
+    conn.execute(text("UPDATE disease SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+    conn.execute(text(
+        "INSERT INTO disease_prompt_version (disease_id, version, system_prompt, created_at) "
+        "SELECT id, prompt_version, system_prompt, updated_at FROM disease WHERE id NOT IN "
+        "(SELECT disease_id FROM disease_prompt_version)"
+    ))
+
+
+def _add_disease_synonyms(conn, metadata):
+    _add_columns(conn, "disease", [("synonyms", "TEXT")])
+
+
+def _add_classroom_analytics(conn, metadata):
+    _add_columns(conn, "chat_session", [
+        ("submitted_diagnosis", "TEXT"), ("matched_disease_id", "INTEGER"), ("question_count", "INTEGER")
+    ])
+    conn.execute(text(
+        "UPDATE chat_session SET question_count = (SELECT COUNT(*) FROM chat_message "
+        "WHERE chat_message.session_id = chat_session.id AND chat_message.sender = 'student') "
+        "WHERE is_completed = :done AND question_count IS NULL"
+    ), {"done": True})
+
+    # Seed the rollups from past sessions. Their answers were never stored,
+    # so they count towards accuracy, time and questions but not the
+    # confusion matrix.
+    stats = metadata.tables["classroom_disease_stats"]
+    if conn.execute(select(stats.c.classroom_id).limit(1)).first():
+        return
+    sessions, users = metadata.tables["chat_session"], metadata.tables["user"]
+    rows = conn.execute(
+        select(users.c.classroom_id, sessions.c.disease_id, sessions.c.was_correct,
+               sessions.c.start_time, sessions.c.end_time, sessions.c.question_count)
+        .join_from(sessions, users, sessions.c.user_id == users.c.id)
+        .where(sessions.c.is_completed == True, users.c.classroom_id.is_not(None))
+    ).all()
+    by_classroom = {}
+    for row in rows:
+        by_classroom.setdefault(row.classroom_id, []).append(row)
+    for classroom_id, group in by_classroom.items():
+        totals, _ = aggregate(
+            [row.disease_id for row in group],
+            [row.was_correct for row in group],
+            [(row.end_time - row.start_time).total_seconds() if row.start_time and row.end_time else 0.0 for row in group],
+            [row.question_count for row in group],
+            [None] * len(group)
+        )
+        conn.execute(stats.insert(), [
+            {"classroom_id": classroom_id, "disease_id": disease_id, "cases_completed": t.completed,
+             "cases_correct": t.correct, "total_seconds": t.seconds, "total_questions": t.questions}
+            for disease_id, t in totals.items()
+        ])
+
+
+def _widen_password_hash(conn, metadata):
+    # scrypt hashes are ~162 characters. SQLite does not enforce VARCHAR
+    # lengths, so only servers that do need the change.
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        conn.execute(text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(255)'))
+    elif dialect in ("mysql", "mariadb"):
+        conn.execute(text("ALTER TABLE `user` MODIFY password_hash VARCHAR(255) NOT NULL"))
+
+
+def _add_user_disease_stats(conn, metadata):
+    # Seeds the per-disease counters from past sessions.
+    stats = metadata.tables["user_disease_stats"]
+    if conn.execute(select(stats.c.user_id).limit(1)).first():
+        return
+    conn.execute(text(
+        "INSERT INTO user_disease_stats (user_id, disease_id, cases_completed, cases_correct) "
+        "SELECT user_id, disease_id, COUNT(*), SUM(CASE WHEN was_correct = :yes THEN 1 ELSE 0 END) "
+        "FROM chat_session WHERE is_completed = :yes GROUP BY user_id, disease_id"
+    ), {"yes": True})
+
+
+MIGRATIONS = [
+    (1, "Hot-path indexes and unique (user_id, badge_name)", _add_hot_path_indexes),
+    (2, "Versioned disease prompts", _add_disease_prompt_versions),
+    (3, "Disease synonyms for diagnosis matching", _add_disease_synonyms),
+    (4, "Session history index (user_id, start_time, id)", _create_indexes),
+    (5, "Classroom analytics columns and rollups", _add_classroom_analytics),
+    (6, "Widen user.password_hash to 255 characters", _widen_password_hash),
+    (7, "Per-disease user counters for case selection", _add_user_disease_stats),
+]
+
+
+def run_migrations(engine, metadata):
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        applied = set(conn.execute(select(schema_version.c.version)).scalars())
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn, metadata)
+            conn.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.datetime.utcnow()
+            ))
+        print(f"Applied migration {version}: {description}")
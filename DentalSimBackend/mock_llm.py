@@ -0,0 +1,128 @@
+import time
+import json
+import random
+import argparse
+import threading
+from flask import Flask, Response, request, jsonify
+
+# --- STUB PATIENT GENERATOR ---
+# Stands in for the Colab /generate server so the backend can be exercised
+# and benchmarked without a GPU. The latency model mimics a GPU with
+# `concurrency` slots (1 by default): each call's base latency is drawn from
+# `distribution`, and a batch costs one forward pass plus a small per-item
+# overhead, which is what makes batching pay off on the real model.
+#
+# Distributions, parameterized by base latency and jitter (ms):
+#   constant  - always the base latency
+#   uniform   - base +/- jitter
+#   normal    - mean base, standard deviation jitter
+#   lognormal - median base, long right tail (sigma = jitter / base)
+
+STUB_REPLY = "It hurts a bit when I drink something cold, but it goes away quickly."
+
+
+class StubGenerator:
+    def __init__(self, base_latency_ms=300, per_item_ms=20, per_token_ms=0,
+                 distribution="constant", jitter_ms=0, concurrency=1, error_rate=0.0):
+        self.base_latency = base_latency_ms / 1000.0
+        self.per_item = per_item_ms / 1000.0
+        self.per_token = per_token_ms / 1000.0
+        self.distribution = distribution
+        self.jitter = jitter_ms / 1000.0
+        self.error_rate = error_rate
+        self.calls = 0
+        self._gpu = threading.BoundedSemaphore(concurrency)
+
+    def sample_latency(self):
+        if self.distribution == "uniform":
+            latency = random.uniform(self.base_latency - self.jitter, self.base_latency + self.jitter)
+        elif self.distribution == "normal":
+            latency = random.gauss(self.base_latency, self.jitter)
+        elif self.distribution == "lognormal" and self.base_latency > 0:
+            latency = random.lognormvariate(0, self.jitter / self.base_latency) * self.base_latency
+        else:
+            latency = self.base_latency
+        return max(0.0, latency)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def _reply_for(self, payload):
+        # Echoes the last student question so replies stay distinguishable.
+        messages = payload.get("messages") or []
+        question = messages[-1]["content"] if messages else ""
+        return f"{STUB_REPLY} (you asked: {question})"
+
+    def _run(self, seconds):
+        with self._gpu:
+            self.calls += 1
+            time.sleep(seconds)
+
+    def generate(self, payload):
+        reply = self._reply_for(payload)
+        self._run(self.sample_latency() + self.per_token * len(reply.split()))
+        return reply
+
+    def generate_batch(self, payloads):
+        replies = [self._reply_for(p) for p in payloads]
+        longest = max((len(r.split()) for r in replies), default=0)
+        self._run(self.sample_latency() + self.per_item * (len(payloads) - 1) + self.per_token * longest)
+        return replies
+
+    def stream(self, payload):
+        reply = self._reply_for(payload)
+        with self._gpu:
+            self.calls += 1
+            time.sleep(self.sample_latency())
+            for word in reply.split(" "):
+                time.sleep(self.per_token)
+                yield word + " "
+
+
+def create_mock_app(generator):
+    mock = Flask(__name__)
+
+    @mock.route("/health", methods=["GET"])
+    def health():
+        return jsonify({"ok": True})
+
+    @mock.route("/generate", methods=["POST"])
+    def generate():
+        payload = request.get_json()
+        if generator.should_fail():
+            return jsonify({"error": "Injected failure"}), 500
+        if payload.get("stream"):
+            def events():
+                for token in generator.stream(payload):
+                    yield f"data: {json.dumps({'token': token})}\n\n"
+                yield "data: [DONE]\n\n"
+            return Response(events(), mimetype="text/event-stream")
+        return jsonify({"generated_text": generator.generate(payload)})
+
+    @mock.route("/generate_batch", methods=["POST"])
+    def generate_batch():
+        payloads = request.get_json().get("requests", [])
+        if generator.should_fail():
+            return jsonify({"error": "Injected failure"}), 500
+        return jsonify({"generated_texts": generator.generate_batch(payloads)})
+
+    return mock
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub patient generator for local runs and benchmarks")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--base-latency-ms", type=float, default=300)
+    parser.add_argument("--per-item-ms", type=float, default=20)
+    parser.add_argument("--per-token-ms", type=float, default=0)
+    parser.add_argument("--distribution", choices=["constant", "uniform", "normal", "lognormal"], default="constant")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--concurrency", type=int, default=1, help="generations served at once")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with HTTP 500")
+    args = parser.parse_args()
+
+    stub = StubGenerator(args.base_latency_ms, args.per_item_ms, args.per_token_ms,
+                         distribution=args.distribution, jitter_ms=args.jitter_ms,
+                         concurrency=args.concurrency, error_rate=args.error_rate)
+    print(f"Stub generator on port {args.port} (set COLAB_URL=http://127.0.0.1:{args.port})")
+    create_mock_app(stub).run(host="127.0.0.1", port=args.port, threaded=True)
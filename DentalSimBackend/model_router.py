@@ -0,0 +1,306 @@
+import time
+import contextlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+# --- MODEL ROUTING ---
+# Spreads patient-model calls over several generator replicas, each given by
+# its base URL (".../generate" and ".../health" are appended).
+#
+# - Balancing: each call goes to the replica with the lowest
+#   latency * (in-flight + 1), latency being a moving average of how long
+#   its recent answers took (time to headers for streamed replies).
+# - Circuit breaker: `failure_threshold` failures in a row (connection
+#   errors, timeouts, 5xx) open a replica's circuit and it gets no traffic
+#   for `open_seconds`. After that one probe request is let through; its
+#   result closes or reopens the circuit. A passing health check also lets
+#   the probe through early.
+# - Retries: a failed call is tried again on another replica, up to
+#   `max_attempts` replicas and always within the caller's deadline.
+#   Streamed replies are only retried before the first byte arrives.
+# - Hedging (hedge_after_ms > 0): a whole-reply call that has not answered
+#   by then is also sent to a second replica and the first good answer
+#   wins. The slower call runs to completion, so set this well above the
+#   usual reply time.
+# - Health checks: every `health_interval` seconds each replica's health
+#   URL is fetched; any answer below 500 counts as up.
+
+
+class NoBackendAvailable(requests.ConnectionError):
+    def __init__(self):
+        super().__init__("No patient model replica is available")
+
+
+class Backend:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.generate_url = f"{self.base_url}/generate"
+        self.latency = None
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+        self.requests = 0
+        self.failures = 0
+
+
+class ModelRouter:
+    def __init__(self, base_urls, headers=None, pool_maxsize=8, max_attempts=2, hedge_after_ms=0,
+                 failure_threshold=3, open_seconds=30, health_path="/health", health_interval=10,
+                 health_timeout=5, latency_alpha=0.2, default_latency=1.0):
+        if not base_urls:
+            raise ValueError("At least one model endpoint is required")
+        self.backends = [Backend(url) for url in base_urls]
+        self.headers = headers or {"Content-Type": "application/json"}
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_after = hedge_after_ms / 1000.0
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.health_path = health_path
+        self.health_timeout = health_timeout
+        self.latency_alpha = latency_alpha
+        self.default_latency = default_latency
+
+        self.retries = 0
+        self.hedges = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends) + 1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._hedge_pool = None
+        if self.hedge_after > 0:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=pool_maxsize * 2, thread_name_prefix="llm-hedge")
+        self._health_thread = None
+        if health_interval > 0:
+            self._health_thread = threading.Thread(target=self._check_health, args=(health_interval,),
+                                                   name="llm-health", daemon=True)
+            self._health_thread.start()
+
+    # Picking and bookkeeping; everything under self._lock.
+
+    def _available(self, backend, now):
+        if backend.state == Backend.CLOSED:
+            return True
+        if backend.state == Backend.OPEN and now - backend.opened_at >= self.open_seconds:
+            backend.state = Backend.HALF_OPEN
+        return backend.state == Backend.HALF_OPEN and not backend.probing
+
+    def _pick(self, exclude):
+        # -> least loaded available replica not in `exclude`, marked in flight
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and self._available(b, now)]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.latency or self.default_latency) * (b.in_flight + 1))
+            if backend.state == Backend.HALF_OPEN:
+                backend.probing = True
+            backend.in_flight += 1
+            backend.requests += 1
+            return backend
+
+    def _finish(self, backend, ok, seconds=None):
+        with self._lock:
+            backend.in_flight -= 1
+            backend.probing = False
+            if ok:
+                if seconds is not None:
+                    backend.latency = seconds if backend.latency is None else (
+                        self.latency_alpha * seconds + (1 - self.latency_alpha) * backend.latency)
+                backend.consecutive_failures = 0
+                if backend.state != Backend.CLOSED:
+                    print(f"Model endpoint {backend.base_url} recovered")
+                backend.state = Backend.CLOSED
+            else:
+                backend.failures += 1
+                self._failed(backend)
+
+    def _failed(self, backend):
+        backend.consecutive_failures += 1
+        if backend.state == Backend.HALF_OPEN or (
+                backend.state == Backend.CLOSED and backend.consecutive_failures >= self.failure_threshold):
+            if backend.state == Backend.CLOSED:
+                print(f"Model endpoint {backend.base_url} failed {backend.consecutive_failures} times, opening circuit")
+            backend.state = Backend.OPEN
+            backend.opened_at = time.monotonic()
+
+    # Calls.
+
+    def _call(self, backend, payload, timeout, stream=False):
+        # One attempt against one replica; returns the response, or raises.
+        started = time.monotonic()
+        try:
+            response = self.session.post(backend.generate_url, json=payload, headers=self.headers,
+                                         timeout=max(0.001, timeout), stream=stream)
+        except requests.RequestException:
+            self._finish(backend, False)
+            raise
+        if response.status_code >= 500:
+            response.close()
+            self._finish(backend, False)
+        elif not stream:
+            self._finish(backend, True, time.monotonic() - started)
+        return response
+
+    def post(self, payload, timeout):
+        # Whole-reply call with retries (and hedging, if enabled). Returns the
+        # first response below 500; otherwise the last 5xx response, or
+        # raises the last error.
+        if self._hedge_pool:
+            return self._post_hedged(payload, timeout)
+        deadline = time.monotonic() + timeout
+        tried = []
+        outcome = NoBackendAvailable()
+        while len(tried) < self.max_attempts and time.monotonic() < deadline:
+            backend = self._pick(tried)
+            if backend is None:
+                break
+            if tried:
+                self.retries += 1
+            tried.append(backend)
+            try:
+                response = self._call(backend, payload, deadline - time.monotonic())
+            except requests.RequestException as e:
+                outcome = e
+                continue
+            if response.status_code < 500:
+                return response
+            outcome = response
+        return _result(outcome)
+
+    def _post_hedged(self, payload, timeout):
+        deadline = time.monotonic() + timeout
+        tried, pending = [], {}
+        outcome = NoBackendAvailable()
+        next_hedge = None
+        while True:
+            now = time.monotonic()
+            can_launch = len(tried) < self.max_attempts
+            if can_launch and (not pending or now >= next_hedge):
+                backend = self._pick(tried)
+                if backend is None:
+                    next_hedge = float("inf")
+                else:
+                    if tried:
+                        if pending:
+                            self.hedges += 1
+                        else:
+                            self.retries += 1
+                    tried.append(backend)
+                    pending[self._hedge_pool.submit(self._call, backend, payload, deadline - now)] = backend
+                    next_hedge = now + self.hedge_after
+                    can_launch = len(tried) < self.max_attempts
+            if not pending:
+                return _result(outcome)
+            if now >= deadline:
+                raise requests.Timeout()
+
+            wait_for = deadline - now
+            if can_launch:
+                wait_for = min(wait_for, max(0, next_hedge - now))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    outcome = e
+                    next_hedge = time.monotonic()  # retry straight away
+                    continue
+                if response.status_code < 500:
+                    return response
+                outcome = response
+                next_hedge = time.monotonic()
+
+    @contextlib.contextmanager
+    def stream(self, payload, timeout):
+        # Streamed call: retried like post() until a replica answers with
+        # headers below 500, then yields that response. The replica counts
+        # as in flight until the block exits; an error raised inside the
+        # block counts as a failure of that replica, unless it answered 4xx.
+        deadline = time.monotonic() + timeout
+        tried = []
+        outcome = NoBackendAvailable()
+        while len(tried) < self.max_attempts and time.monotonic() < deadline:
+            backend = self._pick(tried)
+            if backend is None:
+                break
+            if tried:
+                self.retries += 1
+            tried.append(backend)
+            started = time.monotonic()
+            try:
+                response = self._call(backend, payload, deadline - started, stream=True)
+            except requests.RequestException as e:
+                outcome = e
+                continue
+            if response.status_code >= 500:
+                outcome = response
+                continue
+
+            time_to_headers = time.monotonic() - started
+            try:
+                yield response
+            except Exception:
+                # A 4xx relayed as an error means the request was bad, not
+                # the replica; post() counts it as an answer too.
+                if response.status_code >= 400:
+                    self._finish(backend, True, time_to_headers)
+                else:
+                    self._finish(backend, False)
+                raise
+            except BaseException:
+                # The client went away; says nothing about the replica.
+                self._finish(backend, True)
+                raise
+            self._finish(backend, True, time_to_headers)
+            return
+        yield _result(outcome)
+
+    # Health checks.
+
+    def _check_health(self, interval):
+        while not self._closed.wait(interval):
+            for backend in self.backends:
+                try:
+                    up = self.session.get(backend.base_url + self.health_path, timeout=self.health_timeout).status_code < 500
+                except requests.RequestException:
+                    up = False
+                with self._lock:
+                    if not up:
+                        self._failed(backend)
+                    elif backend.state == Backend.OPEN:
+                        backend.state = Backend.HALF_OPEN
+
+    def snapshot(self):
+        with self._lock:
+            return [{
+                "url": b.base_url,
+                "state": b.state,
+                "in_flight": b.in_flight,
+                "latency_ms": round(b.latency * 1000, 1) if b.latency is not None else None,
+                "requests": b.requests,
+                "failures": b.failures
+            } for b in self.backends]
+
+    def close(self):
+        self._closed.set()
+        if self._hedge_pool:
+            self._hedge_pool.shutdown(wait=False)
+        self.session.close()
+
+
+def _result(outcome):
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
@@ -0,0 +1,58 @@
+import os
+import time
+import contextlib
+from sqlalchemy import text
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# --- CROSS-PROCESS LOCK ---
+# Serializes one-time startup work (schema, migrations, catalog seeding)
+# between worker processes. On Postgres this is an advisory lock, which also
+# covers workers on other hosts; otherwise an exclusive lock on a file next
+# to the database, which covers the processes of one machine.
+
+ADVISORY_LOCK_ID = 4470131  # any constant shared by all workers
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a+") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def _advisory_lock(engine):
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+
+
+def startup_lock(engine, lock_path):
+    if engine.dialect.name == "postgresql":
+        return _advisory_lock(engine)
+    return _file_lock(lock_path)
@@ -0,0 +1,82 @@
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- PATIENT REPLY CACHE ---
+# With a fixed system prompt and a low temperature, the same opening question
+# for the same disease gets the same answer. Replies are cached per
+# (disease, normalized question, hash of the last few messages) with LRU
+# eviction, a TTL and a size limit.
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    text = _PUNCTUATION.sub(" ", text.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=2048, ttl=3600, context_messages=2):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.context_messages = context_messages
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def make_key(self, disease_id, question, history):
+        # `history` is the conversation before the question, without the
+        # system prompt. Only the trailing `context_messages` count.
+        recent = history[-self.context_messages:] if self.context_messages else []
+        context = json.dumps([[m["role"], normalize_question(m["content"])] for m in recent])
+        context_hash = hashlib.sha1(context.encode("utf-8")).hexdigest()
+        return (disease_id, normalize_question(question), context_hash)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            reply, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key, reply):
+        if not self.enabled or not reply:
+            return
+        with self._lock:
+            self._entries[key] = (reply, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_disease(self, disease_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == disease_id]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
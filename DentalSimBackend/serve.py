@@ -0,0 +1,88 @@
+import os
+import sys
+import signal
+
+# --- PRODUCTION SERVER ---
+# Runs the backend without the development server:
+#   gunicorn (default on Linux/macOS): WEB_CONCURRENCY worker processes with
+#     WEB_THREADS threads each. Threaded workers, because a streamed reply
+#     holds its thread until the last token; the LLM gateway admits fewer
+#     requests than there are threads (LLM_RESERVED_THREADS in app.py).
+#   waitress (default on Windows, or SERVER=waitress): one process with
+#     WEB_THREADS threads.
+# Every worker calls create_app(), which initializes the database once
+# across workers. On SIGTERM/SIGINT a worker stops taking connections, gives
+# running requests up to GRACEFUL_TIMEOUT seconds, then drains the LLM
+# gateway and the chat write-behind queue.
+#
+# Each worker keeps its own caches, leaderboard and context store. A cached
+# session context is checked against the database's message count on every
+# turn and rebuilt when another worker has saved a turn since
+# (CONTEXT_STORE_VERIFY, on whenever WEB_CONCURRENCY > 1). With
+# CHAT_WRITE_BEHIND=1, rows still buffered in one worker are not visible to
+# the others until they are written (CHAT_WRITE_BEHIND_INTERVAL_MS).
+#
+#   python serve.py
+#   WEB_CONCURRENCY=4 WEB_THREADS=16 PORT=9003 python serve.py
+
+
+def settings():
+    return {
+        "server": os.environ.get("SERVER") or ("waitress" if sys.platform == "win32" else "gunicorn"),
+        "host": os.environ.get("HOST", "0.0.0.0"),
+        "port": int(os.environ.get("PORT", 9003)),
+        "workers": int(os.environ.get("WEB_CONCURRENCY", 2)),
+        "threads": int(os.environ.get("WEB_THREADS", 16)),
+        "graceful_timeout": int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+    }
+
+
+def run_gunicorn(config):
+    from gunicorn.app.base import BaseApplication
+
+    def worker_exit(server, worker):
+        from app import shutdown
+        shutdown()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{config['host']}:{config['port']}")
+            self.cfg.set("workers", config["workers"])
+            self.cfg.set("threads", config["threads"])
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("graceful_timeout", config["graceful_timeout"])
+            self.cfg.set("worker_exit", worker_exit)
+
+        def load(self):
+            # Imported in each worker, after the fork, so no connections or
+            # background threads are shared between processes.
+            from app import create_app
+            return create_app()
+
+    Server().run()
+
+
+def run_waitress(config):
+    from waitress import serve
+    from app import create_app, shutdown
+
+    app = create_app()
+    # waitress only handles SIGINT; turn SIGTERM into the same clean exit.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(app, host=config["host"], port=config["port"], threads=config["threads"])
+    finally:
+        shutdown(config["graceful_timeout"])
+
+
+if __name__ == "__main__":
+    config = settings()
+    # The app sizes its LLM gateway to the thread count, and checks cached
+    # session contexts only when there are several workers.
+    os.environ["WEB_THREADS"] = str(config["threads"])
+    os.environ["WEB_CONCURRENCY"] = str(config["workers"] if config["server"] == "gunicorn" else 1)
+    print(f"Starting DentalSim Backend ({config['server']}) on {config['host']}:{config['port']}")
+    if config["server"] == "waitress":
+        run_waitress(config)
+    else:
+        run_gunicorn(config)
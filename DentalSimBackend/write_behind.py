@@ -0,0 +1,151 @@
+import time
+import atexit
+import datetime
+import threading
+from collections import deque
+
+# --- WRITE-BEHIND PERSISTENCE ---
+# Buffers chat messages and writes them in batched transactions from one
+# background thread, so a chat turn never waits on a commit. A batch is
+# written once `max_batch` rows are waiting or `interval_ms` after the first
+# of them arrived, whichever comes first.
+#
+# Rows are written in the order they were enqueued, so messages of a session
+# keep their order (their timestamps are taken at enqueue time). Rows not
+# written yet are visible through pending_for(), for readers that rebuild a
+# session from the database. close() - also registered with atexit - writes
+# everything still buffered; a hard crash loses at most one interval.
+#
+# When a batch fails its rows are retried one at a time, so one bad row
+# cannot hold up the rest. A row that fails on its own `max_row_attempts`
+# times is logged and set aside (kept in `rejected`, newest last).
+
+
+class WriteBehindQueue:
+    def __init__(self, write_rows, max_batch=200, interval_ms=50, retry_seconds=1.0, max_row_attempts=5,
+                 max_rejected=1000):
+        # write_rows(rows) -> stores a list of row dicts in one transaction
+        self.write_rows = write_rows
+        self.max_batch = max_batch
+        self.interval = interval_ms / 1000.0
+        self.retry_seconds = retry_seconds
+        self.max_row_attempts = max_row_attempts
+
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failures = 0
+        self.rows_rejected = 0
+        self.rejected = deque(maxlen=max_rejected)
+        self._attempts = {}  # id(row) -> failed single-row writes
+
+        self._pending = deque()
+        self._writing = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def enqueue(self, session_id, sender, content):
+        row = {
+            "session_id": session_id,
+            "sender": sender,
+            "content": content,
+            "timestamp": datetime.datetime.utcnow()
+        }
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._pending.append(row)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+        return row
+
+    def pending_for(self, session_id):
+        # Rows of the session that are buffered or being written, oldest first.
+        with self._cond:
+            return [row for row in self._writing + list(self._pending) if row["session_id"] == session_id]
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending) + len(self._writing)
+
+    def flush(self, timeout=None):
+        # Blocks until everything enqueued so far has been written.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=30):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # Give the batch until the interval is over (or it is full) to grow.
+                window_end = time.monotonic() + self.interval
+                while not self._closed and len(self._pending) < self.max_batch:
+                    remaining = window_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                while self._pending and len(self._writing) < self.max_batch:
+                    self._writing.append(self._pending.popleft())
+                batch = list(self._writing)
+
+            try:
+                self.write_rows(batch)
+            except Exception as e:
+                self.failures += 1
+                print(f"Write-behind flush of {len(batch)} rows failed, retrying them one by one: {e}")
+                written, retry = self._write_singly(batch)
+                if retry:
+                    # Probably the database itself; give it a moment.
+                    time.sleep(self.retry_seconds)
+                with self._cond:
+                    self._pending.extendleft(reversed(retry))
+                    self._writing = []
+                    self.rows_written += written
+                    self._cond.notify_all()
+                continue
+
+            with self._cond:
+                self._writing = []
+                self.rows_written += len(batch)
+                self.batches_written += 1
+                self._cond.notify_all()
+
+    def _write_singly(self, batch):
+        # -> (rows written, rows to retry, in order)
+        written, retry = 0, []
+        for row in batch:
+            try:
+                self.write_rows([row])
+            except Exception as e:
+                attempts = self._attempts.pop(id(row), 0) + 1
+                if attempts < self.max_row_attempts:
+                    self._attempts[id(row)] = attempts
+                    retry.append(row)
+                    continue
+                self.rows_rejected += 1
+                self.rejected.append(row)
+                print(f"Write-behind row for session {row['session_id']} failed {attempts} times, setting it aside: {e}")
+                continue
+            self._attempts.pop(id(row), None)
+            written += 1
+        return written, retry
@@ -141,7 +141,7 @@ const DiagnosisPage: React.FC = () => {
             const token = localStorage.getItem('token');
             if (!token || !caseId) throw new Error("Session invalid");
 
-            const response = await fetch(`${API_BASE_URL}/chat`, {
+            const response = await fetch(`${API_BASE_URL}/chat/stream`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -153,17 +153,62 @@ const DiagnosisPage: React.FC = () => {
                 })
             });
 
-            const data = await response.json();
-
-            if (!response.ok) throw new Error(data.error || 'Failed to send');
+            if (!response.ok || !response.body) {
+                const data = await response.json().catch(() => ({}));
+                throw new Error(data.error || 'Failed to send');
+            }
 
-            const aiMessage: Message = {
-                id: (Date.now() + 1).toString(),
+            // The reply arrives as server-sent events; show tokens as they come in.
+            const aiMessageId = (Date.now() + 1).toString();
+            let replyText = '';
+            setMessages((prev) => [...prev, {
+                id: aiMessageId,
                 type: 'patient',
-                content: data.reply,
+                content: '',
                 timestamp: new Date(),
-            };
-            setMessages((prev) => [...prev, aiMessage]);
+            }]);
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let streamError: string | null = null;
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                const events = buffer.split('\n\n');
+                buffer = events.pop() || '';
+
+                for (const rawEvent of events) {
+                    let eventName = 'message';
+                    let dataLine = '';
+                    for (const line of rawEvent.split('\n')) {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        if (line.startsWith('data:')) dataLine += line.slice(5).trim();
+                    }
+                    if (!dataLine) continue;
+                    const data = JSON.parse(dataLine);
+
+                    if (eventName === 'error') {
+                        streamError = data.error || 'Stream failed';
+                    } else if (eventName === 'done') {
+                        replyText = data.reply;
+                    } else if (data.token) {
+                        replyText += data.token;
+                    }
+                    setIsAITyping(false);
+                    setMessages((prev) => prev.map((m) =>
+                        m.id === aiMessageId ? { ...m, content: replyText } : m
+                    ));
+                }
+            }
+
+            if (streamError) {
+                setMessages((prev) => prev.filter((m) => m.id !== aiMessageId || m.content));
+                throw new Error(streamError);
+            }
 
         } catch (err: any) {
             console.error(err);